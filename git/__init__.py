@@ -1,5 +1,6 @@
 from __future__ import absolute_import, unicode_literals, print_function, division
 
+import codecs
 import os
 import re
 import sublime
@@ -8,10 +9,12 @@ import threading
 import subprocess
 import functools
 import os.path
+import select
 import time
+import traceback
+from collections import deque
 
 
-git_root_cache = {}
 _has_warned = False
 
 
@@ -48,32 +51,149 @@ def open_url(url):
     sublime.active_window().run_command('open_url', {"url": url})
 
 
+class RootNode(object):
+    __slots__ = ('children', 'root', 'next', 'stamp', 'checked')
+
+    def __init__(self):
+        self.children = {}
+        # the answer: a root, False for "not in a repository", None for unknown
+        self.root = None
+        # the node for the next directory up that the answer depends on
+        self.next = None
+        self.stamp = None
+        self.checked = 0
+
+
+class RootIndex(object):
+    """Remembers git_root() answers in a trie of path components.
+
+    Every directory passed through while looking for a root gets the answer
+    too, so the rest of a project's files are a lookup away, and so are the
+    directories that turned out not to be in a repository at all. An answer
+    stays good until one of the directories it was worked out from changes
+    on disk (a .git appearing or going, say); that's checked with a stat
+    each, at most once every CHECK_INTERVAL seconds.
+    """
+    CHECK_INTERVAL = 1
+    MAX_NODES = 8192
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.top = RootNode()
+        self.size = 0
+
+    def node(self, directory):
+        node = self.top
+        for part in os.path.normpath(directory).split(os.sep):
+            child = node.children.get(part)
+            if child is None:
+                if self.size >= self.MAX_NODES:
+                    # start over rather than keep track of what's least used
+                    self.clear()
+                    return self.node(directory)
+                child = node.children[part] = RootNode()
+                self.size += 1
+            node = child
+        return node
+
+    def valid(self, node, now):
+        while node is not None:
+            if now - node.checked > self.CHECK_INTERVAL:
+                if file_stamp(node.stamp[0]) != node.stamp[1]:
+                    return False
+                node.checked = now
+            node = node.next
+        return True
+
+    def find(self, directory):
+        with self.lock:
+            now = time.time()
+            leaf = self.node(directory)
+            if leaf.root is not None and self.valid(leaf, now):
+                return leaf.root
+
+            walked = []
+            root = False
+            while directory:
+                node = self.node(directory)
+                if node is not leaf and node.root is not None and self.valid(node, now):
+                    root = node.root
+                    walked.append(node)
+                    break
+                marker = os.path.join(directory, '.git')
+                if os.path.isdir(git_dir(directory)):
+                    # a .git directory, or the .git file of a worktree or
+                    # submodule pointing at one
+                    node.root = directory
+                    node.next = None
+                    node.stamp = (marker, file_stamp(marker))
+                    node.checked = now
+                    root = directory
+                    walked.append(node)
+                    break
+                node.stamp = (directory, file_stamp(directory))
+                node.checked = now
+                walked.append(node)
+                parent = os.path.realpath(os.path.join(directory, os.path.pardir))
+                if parent == directory:
+                    # /.. == /
+                    node.root = False
+                    node.next = None
+                    break
+                directory = parent
+
+            # everything on the way up shares the answer, and depends on
+            # the directory above it staying the same
+            for node, up in zip(walked, walked[1:]):
+                node.root = root
+                node.next = up
+            return root
+
+
+root_index = RootIndex()
+
+
 def git_root(directory):
-    global git_root_cache
+    if not directory:
+        return False
+    return root_index.find(directory)
 
-    retval = False
-    leaf_dir = directory
 
-    if leaf_dir in git_root_cache and git_root_cache[leaf_dir]['expires'] > time.time():
-        return git_root_cache[leaf_dir]['retval']
+def git_dir(root):
+    # Usually root/.git, but worktrees and submodules have a .git file
+    # pointing at the real directory instead
+    path = os.path.join(root, '.git')
+    if os.path.isfile(path):
+        try:
+            with open(path) as f:
+                line = f.readline().strip()
+        except (IOError, OSError):
+            return path
+        if line.startswith('gitdir:'):
+            return os.path.normpath(os.path.join(root, line[len('gitdir:'):].strip()))
+    return path
 
-    while directory:
-        if os.path.exists(os.path.join(directory, '.git')):
-            retval = directory
-            break
-        parent = os.path.realpath(os.path.join(directory, os.path.pardir))
-        if parent == directory:
-            # /.. == /
-            retval = False
-            break
-        directory = parent
 
-    git_root_cache[leaf_dir] = {
-        'retval': retval,
-        'expires': time.time() + 5
-    }
+def git_common_dir(gitdir):
+    # A worktree keeps its own HEAD and index, but shares refs with the main
+    # repository, which its commondir file points at
+    try:
+        with open(os.path.join(gitdir, 'commondir')) as f:
+            return os.path.normpath(os.path.join(gitdir, f.readline().strip()))
+    except (IOError, OSError):
+        return gitdir
 
-    return retval
+
+def file_stamp(path):
+    # Enough to tell whether a file has changed without reading it
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
 
 
 # for readability code
@@ -126,6 +246,15 @@ def _make_text_safeish(text, fallback_encoding, method='decode'):
     return unitext
 
 
+def _decode_object(data, fallback_encoding):
+    # For git objects read in the background, where a blob that's neither
+    # UTF-8 nor the fallback encoding mustn't raise
+    try:
+        return _make_text_safeish(data, fallback_encoding)
+    except (UnicodeError, LookupError):
+        return data.decode('utf-8', 'replace')
+
+
 def _test_paths_for_executable(paths, test_file):
     for directory in paths:
         file_path = os.path.join(directory, test_file)
@@ -165,16 +294,106 @@ GIT = find_binary('git')
 GITK = find_binary('gitk')
 
 
+def git_binary():
+    s = sublime.load_settings("Git.sublime-settings")
+    us = sublime.load_settings('Preferences.sublime-settings')
+    return s.get('git_command') or us.get('git_binary') or GIT or 'git'
+
+
+def popen_options(background=False):
+    # Windows needs startupinfo in order to start process in background
+    startupinfo = None
+    if os.name == 'nt':
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+
+    env = os.environ.copy()
+    if background:
+        # Background commands can now run alongside interactive ones,
+        # so keep the likes of `status` from taking index.lock.
+        env[str('GIT_OPTIONAL_LOCKS')] = str('0')
+
+    shell = False
+    if sublime.platform() == 'windows':
+        shell = True
+        if 'HOME' not in env:
+            env[str('HOME')] = str(env['HOMEDRIVE']) + str(env['HOMEPATH'])
+
+    return {'startupinfo': startupinfo, 'env': env, 'shell': shell}
+
+
+def view_fallback_encoding(view):
+    # e.g. "Western (Windows 1252)" -> "Windows 1252"
+    encoding = view and view.settings().get('fallback_encoding')
+    if encoding:
+        return str(encoding.rpartition('(')[2].rpartition(')')[0])
+
+
 def output_error_message(output, *args, **kwargs):
     # print('error', output, args, kwargs)
     sublime.error_message(output)
 
 
-class CommandThread(threading.Thread):
-    command_lock = threading.Lock()
-
-    def __init__(self, command, on_done, working_dir="", fallback_encoding="", error_suppresses_output=False, **kwargs):
-        threading.Thread.__init__(self)
+class CommandScheduler(object):
+    """Runs jobs on a small, bounded pool of workers per repository root.
+
+    Each root has one queue per lane. A lane's workers only ever take jobs
+    from their own queue, so however much background work (status bar,
+    annotations, ignore sync) piles up it can't hold up an interactive
+    command (quick panels, diffs) in the same repository, and nothing in one
+    repository waits on another. Workers are plain threads that exit as soon
+    as their queue runs dry.
+    """
+    INTERACTIVE = 'interactive'
+    BACKGROUND = 'background'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.workers = {}
+
+    def submit(self, root, lane, job, size=1):
+        key = (root, lane)
+        with self.lock:
+            self.queues.setdefault(key, deque()).append(job)
+            if self.workers.get(key, 0) >= max(1, size):
+                # the workers already running will get to it
+                return
+            self.workers[key] = self.workers.get(key, 0) + 1
+        worker = threading.Thread(target=self.work, args=(key,))
+        worker.daemon = True
+        worker.start()
+
+    def work(self, key):
+        while True:
+            with self.lock:
+                queue = self.queues.get(key)
+                if not queue:
+                    self.workers[key] -= 1
+                    if not self.workers[key]:
+                        del self.workers[key]
+                        self.queues.pop(key, None)
+                    return
+                job = queue.popleft()
+            try:
+                job()
+            except Exception:
+                traceback.print_exc()
+
+
+scheduler = CommandScheduler()
+
+
+def lane_size(lane):
+    s = sublime.load_settings("Git.sublime-settings")
+    sizes = s.get('worker_pool') or {}
+    return sizes.get(lane, 1)
+
+
+# Each CommandThread is a job for the scheduler rather than a thread of its
+# own; the name sticks around for anyone subclassing it.
+class CommandThread(object):
+    def __init__(self, command, on_done, working_dir="", fallback_encoding="", error_suppresses_output=False, background=False, stream=None, **kwargs):
         self.command = command
         self.on_done = on_done
         self.working_dir = working_dir
@@ -188,42 +407,50 @@ class CommandThread(threading.Thread):
             self.stdout = subprocess.PIPE
         self.fallback_encoding = fallback_encoding
         self.error_suppresses_output = error_suppresses_output
+        self.background = background
+        # With stream set, output is handed to stream(text) on the main thread
+        # in batches as it arrives, and on_done just gets git's exit status
+        # at the end
+        self.stream = stream
+        self.proc = None
+        self.cancelled = False
+        # set on the main thread once on_done has been called, or if it
+        # never will be
+        self.finished = False
         self.kwargs = kwargs
 
+    @property
+    def lane(self):
+        return CommandScheduler.BACKGROUND if self.background else CommandScheduler.INTERACTIVE
+
+    def start(self):
+        root = git_root(self.working_dir) or self.working_dir
+        scheduler.submit(root, self.lane, self.run, lane_size(self.lane))
+
     def run(self):
         # Ignore directories that no longer exist
         if not os.path.isdir(self.working_dir):
+            main_thread(self.finish)
             return
 
-        self.command_lock.acquire()
         output = ''
         callback = self.on_done
         try:
             cwd = None
             if self.working_dir != "":
                 cwd = self.working_dir
-            # Windows needs startupinfo in order to start process in background
-            startupinfo = None
-            if os.name == 'nt':
-                startupinfo = subprocess.STARTUPINFO()
-                startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-
-            env = os.environ.copy()
-
-            shell = False
-            if sublime.platform() == 'windows':
-                shell = True
-                if 'HOME' not in env:
-                    env[str('HOME')] = str(env['HOMEDRIVE']) + str(env['HOMEPATH'])
 
             # universal_newlines seems to break `log` in python3
             proc = subprocess.Popen(
                 self.command,
                 stdout=self.stdout, stderr=subprocess.STDOUT,
-                stdin=subprocess.PIPE, startupinfo=startupinfo,
-                shell=shell, universal_newlines=False,
-                env=env, cwd=cwd
+                stdin=subprocess.PIPE, universal_newlines=False,
+                cwd=cwd, **popen_options(self.background)
             )
+            self.proc = proc
+            if self.stream:
+                output = self.run_stream(proc)
+                return
             output = proc.communicate(self.stdin)[0]
             if self.error_suppresses_output and proc.returncode is not None and proc.returncode > 0:
                 output = False
@@ -247,31 +474,156 @@ class CommandThread(threading.Thread):
             else:
                 output = e.strerror
         finally:
-            self.command_lock.release()
+            self.proc = None
             main_thread(callback, output, **self.kwargs)
+            main_thread(self.finish)
+
+    def finish(self):
+        self.finished = True
+
+    # Streamed output goes to the main thread in batches of up to
+    # STREAM_BATCH bytes, or whatever has arrived once STREAM_INTERVAL
+    # seconds pass without it filling up. At most STREAM_BACKLOG batches can
+    # be waiting for the main thread; past that git is left blocked on the
+    # pipe until it catches up.
+    STREAM_CHUNK = 16 * 1024
+    STREAM_BATCH = 256 * 1024
+    STREAM_INTERVAL = 0.05
+    STREAM_BACKLOG = 4
+
+    def run_stream(self, proc):
+        # Returns git's exit status
+        if self.stdin:
+            proc.stdin.write(self.stdin)
+        proc.stdin.close()
+        fd = proc.stdout.fileno()
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        backlog = threading.BoundedSemaphore(self.STREAM_BACKLOG)
+        pending = []
+        size = 0
+        read = 0
+        # so the first screenful goes out as soon as it's read
+        flushed = 0
+        while not self.cancelled:
+            final = False
+            # Only block on the pipe once what's been read is sent, or if
+            # more turns up before it's due to be
+            if not pending or self.more_output(fd, flushed + self.STREAM_INTERVAL - time.time(), read):
+                data = os.read(fd, self.STREAM_CHUNK)
+                read = len(data)
+                final = not data
+                if data:
+                    pending.append(data)
+                    size += len(data)
+                due = final or size >= self.STREAM_BATCH or time.time() - flushed >= self.STREAM_INTERVAL
+            else:
+                due = True
+            if due:
+                data = b''.join(pending)
+                # a utf-8 sequence split across reads is held back by the
+                # decoder; it's part of what has to be decoded again
+                held = decoder.getstate()[0]
+                try:
+                    text = decoder.decode(data, final)
+                except UnicodeDecodeError:
+                    decoder = codecs.getincrementaldecoder(self.fallback_encoding or 'utf-8')('replace')
+                    text = decoder.decode(held + data, final)
+                pending = []
+                size = 0
+                flushed = time.time()
+                if text:
+                    backlog.acquire()
+                    main_thread(self.deliver, text, backlog)
+            if final:
+                break
+        if self.cancelled:
+            # it may have been cancelled before there was a process to kill
+            self.cancel()
+        proc.stdout.close()
+        return proc.wait()
+
+    def more_output(self, fd, timeout, last_read):
+        # Whether there's output waiting, or will be within timeout seconds.
+        # select() only takes sockets on Windows, so there it's a guess: a
+        # read that filled the buffer probably left more behind.
+        if os.name == 'nt':
+            return last_read == self.STREAM_CHUNK
+        return bool(select.select([fd], [], [], max(0, timeout))[0])
+
+    def deliver(self, text, backlog):
+        try:
+            if not self.cancelled:
+                self.stream(text)
+        finally:
+            backlog.release()
+
+    def cancel(self):
+        # Stops a streaming command; any output still on its way is dropped
+        self.cancelled = True
+        proc = self.proc
+        if proc is not None:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+
+
+# Views being streamed into, by view id, so closing one can stop its command
+streams = {}
+
+
+class ScratchStream(object):
+    def __init__(self, command, title, syntax, prefix, empty_callback):
+        self.command = command
+        self.title = title
+        self.syntax = syntax
+        self.prefix = prefix
+        self.empty_callback = empty_callback
+        self.thread = None
+        self.view = None
+
+    def write(self, text):
+        if self.view is None:
+            self.view = self.command.scratch(self.prefix + text, title=self.title, syntax=self.syntax)
+            streams[self.view.id()] = self
+        elif streams.get(self.view.id()) is self:
+            self.view.set_read_only(False)
+            self.view.run_command('git_scratch_output', {'output': text, 'append': True})
+            self.view.set_read_only(True)
+
+    def done(self, returncode):
+        if self.view is None:
+            self.empty_callback()
+        elif streams.get(self.view.id()) is self:
+            del streams[self.view.id()]
+            if returncode:
+                # whatever git had to say about it is in the view already
+                sublime.status_message("git exited with status %d" % returncode)
+
+    def cancel(self):
+        if self.thread is not None:
+            self.thread.cancel()
 
 
 # A base for all commands
 class GitCommand(object):
+    # Whether the command can rewrite files in the working tree; if so, the
+    # open ones it changed are reloaded once it's done
     may_change_files = False
 
-    def run_command(self, command, callback=None, show_status=True, filter_empty_args=True, no_save=False, **kwargs):
+    def run_command(self, command, callback=None, show_status=True, filter_empty_args=True, no_save=False, changes_files=None, **kwargs):
         if filter_empty_args:
             command = [arg for arg in command if arg]
         if 'working_dir' not in kwargs:
             kwargs[str('working_dir')] = str(self.get_working_dir())
-        if 'fallback_encoding' not in kwargs and self.active_view() and self.active_view().settings().get('fallback_encoding'):
-            kwargs[str('fallback_encoding')] = str(self.active_view().settings().get('fallback_encoding').rpartition('(')[2].rpartition(')')[0])
+        if 'fallback_encoding' not in kwargs and view_fallback_encoding(self.active_view()):
+            kwargs[str('fallback_encoding')] = view_fallback_encoding(self.active_view())
 
         s = sublime.load_settings("Git.sublime-settings")
         if s.get('save_first') and self.active_view() and self.active_view().is_dirty() and not no_save:
             self.active_view().run_command('save')
         if command[0] == 'git':
-            us = sublime.load_settings('Preferences.sublime-settings')
-            if s.get('git_command') or us.get('git_binary'):
-                command[0] = s.get('git_command') or us.get('git_binary')
-            elif GIT:
-                command[0] = GIT
+            command[0] = git_binary()
         if command[0] == 'gitk' and s.get('gitk_command'):
             if s.get('gitk_command'):
                 command[0] = s.get('gitk_command')
@@ -280,8 +632,18 @@ class GitCommand(object):
         if command[0] == 'git' and command[1] == 'flow' and s.get('git_flow_command'):
             command[0] = s.get('git_flow_command')
             del(command[1])
+        if changes_files is None:
+            # Of a command's git commands, the one left to generic_done is
+            # the one that changes things, unless the caller says otherwise;
+            # listing branches and the like needn't look at every open file
+            changes_files = self.may_change_files and not callback
         if not callback:
             callback = self.generic_done
+        if changes_files and git_root(kwargs['working_dir']):
+            # to find out afterwards which open files it changed; the
+            # callback has to hand files_before on to generic_done
+            from .repostate import FilesSnapshot
+            kwargs[str('files_before')] = FilesSnapshot(git_root(kwargs['working_dir']))
 
         thread = CommandThread(command, callback, **kwargs)
         thread.start()
@@ -289,19 +651,89 @@ class GitCommand(object):
         if show_status:
             message = kwargs.get('status_message', False) or ' '.join(command)
             sublime.status_message(message)
-
-    def generic_done(self, result, **kw):
-        if self.may_change_files and self.active_view() and self.active_view().file_name():
-            if self.active_view().is_dirty():
-                result = "WARNING: Current view is dirty.\n\n"
-            else:
-                # just asking the current file to be re-opened doesn't do anything
-                print("reverting")
-                position = self.active_view().viewport_position()
-                self.active_view().run_command('revert')
-                do_when(lambda: not self.active_view().is_loading(), lambda: self.active_view().set_viewport_position(position, False))
-                # self.active_view().show(position)
-
+        return thread
+
+    def stream_scratch(self, command, empty_callback, title=False, syntax="Packages/Diff/Diff.tmLanguage", prefix=''):
+        # For commands whose output can be big (log -p, diff, ...): it's shown
+        # in a scratch view as it arrives rather than all at once at the end.
+        # The view only opens once there's some output; if there's none at
+        # all, empty_callback() is called instead.
+        stream = ScratchStream(self, title, syntax, prefix, empty_callback)
+        stream.thread = self.run_command(command, stream.done, stream=stream.write)
+
+    def read_object(self, spec, callback, background=False, **kwargs):
+        # Reads an object (e.g. "HEAD:path/to/file" or a blob hash) through the
+        # repository's long-lived cat-file process rather than `git show`.
+        # callback gets the decoded text, or None if there's no such object.
+        from .objects import object_reader
+        encoding = view_fallback_encoding(self.active_view())
+        reader = object_reader(git_root(self.get_working_dir()))
+
+        def done(data):
+            if data is not None:
+                data = _decode_object(data, encoding)
+            main_thread(callback, data, **kwargs)
+        reader.contents(spec, done, background=background)
+
+    def read_blob(self, ref, path, callback, background=False, **kwargs):
+        # Like read_object('ref:path'), but through the shared blob cache;
+        # ref should be 'HEAD' or something that always names the same commit.
+        from .objects import read_blob
+        encoding = view_fallback_encoding(self.active_view())
+
+        def done(data):
+            if data is not None:
+                data = _decode_object(data, encoding)
+            main_thread(callback, data, **kwargs)
+        read_blob(git_root(self.get_working_dir()), ref, path, done, background=background)
+
+    def read_commit_messages(self, oids, callback, background=False, **kwargs):
+        # callback gets {oid: message}, read through the cat-file process and
+        # cached, however many commits there are
+        from .objects import read_commit_messages
+
+        def done(messages):
+            main_thread(callback, messages, **kwargs)
+        read_commit_messages(git_root(self.get_working_dir()), oids, done, background=background)
+
+    def run_in_background(self, function, callback, *args, **kwargs):
+        # Runs function(*args) on the repository's background lane and hands
+        # its return value to callback on the main thread; for work that's
+        # pure Python but too slow for the main thread. If function raises,
+        # callback still gets called, with None, so nothing waits forever.
+        root = git_root(self.get_working_dir()) or self.get_working_dir()
+
+        def job():
+            result = None
+            try:
+                result = function(*args)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                main_thread(callback, result, **kwargs)
+        scheduler.submit(root, CommandScheduler.BACKGROUND, job, lane_size(CommandScheduler.BACKGROUND))
+
+    def generic_done(self, result, files_before=None, **kw):
+        root = git_root(self.get_working_dir())
+        if (self.may_change_files or files_before is not None) and root:
+            from .repostate import invalidate_repo_state
+            invalidate_repo_state(root)
+            if files_before is not None and files_before.root == root:
+                # reload whichever open files the command changed
+                files_before.changed(functools.partial(self.reload_changed, result))
+                return
+        self.generic_output(result)
+
+    def reload_changed(self, result, views):
+        from .repostate import reload_views
+        dirty = [view for view in views if view.is_dirty()]
+        reload_views([view for view in views if not view.is_dirty()])
+        if dirty:
+            names = '\n'.join(view.file_name() for view in dirty)
+            result = "WARNING: these changed on disk but have unsaved changes, so weren't reloaded:\n%s\n\n%s" % (names, result)
+        self.generic_output(result)
+
+    def generic_output(self, result):
         view = self.active_view()
         if view and view.settings().get('live_git_annotations'):
             view.run_command('git_annotate')
@@ -375,8 +807,7 @@ class GitWindowCommand(GitCommand, sublime_plugin.WindowCommand):
 
     @property
     def fallback_encoding(self):
-        if self.active_view() and self.active_view().settings().get('fallback_encoding'):
-            return self.active_view().settings().get('fallback_encoding').rpartition('(')[2].rpartition(')')[0]
+        return view_fallback_encoding(self.active_view())
 
     # If there's no active view or the active view is not a file on the
     # filesystem (e.g. a search results view), we can infer the folder
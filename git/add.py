@@ -1,18 +1,17 @@
 from __future__ import absolute_import, unicode_literals, print_function, division
 
 import os
-import re
 
 import sublime
 from . import GitTextCommand, GitWindowCommand, git_root
 from .status import GitStatusCommand
-from collections import namedtuple
 from .diff import get_GitDiffRootInView
+from .patch import LineSelection, parse_diff
 
 
 class GitAddChoiceCommand(GitStatusCommand):
-    def status_filter(self, item):
-        return super(GitAddChoiceCommand, self).status_filter(item) and not item[1].isspace()
+    def status_filter(self, entry):
+        return super(GitAddChoiceCommand, self).status_filter(entry) and entry.worktree != ' '
 
     def show_status_list(self):
         self.results = [
@@ -30,7 +29,6 @@ class GitAddChoiceCommand(GitStatusCommand):
             command = ['git', 'add', '--all']
         else:
             command = ['git']
-            picked_file = picked_file.strip('"')
             if os.path.exists(working_dir + "/" + picked_file):
                 command += ['add']
             else:
@@ -68,85 +66,50 @@ class GitAddSelectedHunkCommand(GitTextCommand):
         else:
             self.run_command(['git', 'diff', '--no-color', '-U1', self.get_file_name()], lambda result: self.cull_diff(result, edit_patch))
 
+    def selected_lines(self):
+        return [
+            (self.view.rowcol(sel.begin())[0] + 1, self.view.rowcol(sel.end())[0] + 1)
+            for sel in self.view.sel()
+        ]
+
     def cull_diff(self, result, edit_patch=False, direct_select=False, **kwargs):
-        selection = []
-        for sel in self.view.sel():
-            selection.append({
-                "start": self.view.rowcol(sel.begin())[0] + 1,
-                "end": self.view.rowcol(sel.end())[0] + 1,
-            })
-
-        # We devide the diff output into hunk groups. A file header starts a new group.
-        # Each group can contain zero or more hunks.
-        HunkGroup = namedtuple("HunkGroup", ["fileHeader", "hunkList"])
-        section = []
-        hunks = [HunkGroup(section, [])]  # Initial lines before hunks
-        matcher = re.compile('^@@ -([0-9]*)(?:,([0-9]*))? \+([0-9]*)(?:,([0-9]*))? @@')
-        for line_num, line in enumerate(result.splitlines(keepends=True)):  # if different line endings, patch will not apply
-            if line.startswith('diff'):  # new file
-                section = []
-                hunks.append(HunkGroup(section, []))
-            elif line.startswith('@@'):  # new hunk
-                match = matcher.match(line)
-                start = int(match.group(3))
-                end = match.group(4)
-                if end:
-                    end = start + int(end)
-                else:
-                    end = start
-                section = []
-                hunks[-1].hunkList.append({"diff": section, "start": start, "end": end, "diff_start": line_num + 1, "diff_end": line_num + 1})
-            elif hunks[-1].hunkList:  # new line for file header or hunk
-                hunks[-1].hunkList[-1]["diff_end"] = line_num + 1  # update hunk end
-
-            section.append(line)
-
-        diffs = "".join(hunks[0][0])
-        hunks.pop(0)
-        selection_is_hunky = False
-        for file_header, hunkL in hunks:
-            file_header = "".join(file_header)
-            file_header_added = False
-            for hunk in hunkL:
-                for sel in selection:
-                    # In direct mode the selected view lines correspond directly to the lines of the diff file
-                    # In indirect mode the selected view lines correspond to the lines in the "@@" hunk header
-                    if direct_select:
-                        hunk_start = hunk["diff_start"]
-                        hunk_end = hunk["diff_end"]
-                    else:
-                        hunk_start = hunk["start"]
-                        hunk_end = hunk["end"]
-                    if sel["end"] < hunk_start:
-                        continue
-                    if sel["start"] > hunk_end:
-                        continue
-                    # Only print the file header once
-                    if not file_header_added:
-                        file_header_added = True
-                        diffs += file_header
-                    hunk_str = "".join(hunk["diff"])
-                    diffs += hunk_str  # + "\n\nEND OF HUNK\n\n"
-                    selection_is_hunky = True
-
-        if selection_is_hunky:
-            if edit_patch:  # open an input panel to modify the patch
-                patch_view = self.get_window().show_input_panel(
-                    "Message", diffs,
-                    lambda edited_patch: self.on_input(edited_patch, **kwargs), None, None
-                )
-                s = sublime.load_settings("Git.sublime-settings")
-                syntax = s.get("diff_syntax", "Packages/Diff/Diff.tmLanguage")
-                patch_view.set_syntax_file(syntax)
-                patch_view.settings().set('word_wrap', False)
-            else:
-                self.on_input(diffs, **kwargs)
+        # In direct mode the selected view lines correspond directly to the lines of the diff file
+        # In indirect mode the selected view lines correspond to the lines in the "@@" hunk header
+        diff = parse_diff(result)
+        selected = diff.select(self.selected_lines(), direct_select)
+        if selected:
+            self.apply_patch(diff.patch(selected), edit_patch, **kwargs)
         else:
             sublime.status_message("No selected hunk")
 
+    def apply_patch(self, diffs, edit_patch, **kwargs):
+        if edit_patch:  # open an input panel to modify the patch
+            patch_view = self.get_window().show_input_panel(
+                "Message", diffs,
+                lambda edited_patch: self.on_input(edited_patch, **kwargs), None, None
+            )
+            s = sublime.load_settings("Git.sublime-settings")
+            syntax = s.get("diff_syntax", "Packages/Diff/Diff.tmLanguage")
+            patch_view.set_syntax_file(syntax)
+            patch_view.settings().set('word_wrap', False)
+        else:
+            self.on_input(diffs, **kwargs)
+
     def on_input(self, patch, **kwargs):
         self.run_command(['git', 'apply', '--cached'], stdin=patch, **kwargs)
 
+
+class GitAddSelectedLinesCommand(GitAddSelectedHunkCommand):
+    # Stages just the added and removed lines that are selected rather than
+    # the whole hunks they're in, so there's no patch to edit by hand
+    def cull_diff(self, result, edit_patch=False, direct_select=False, **kwargs):
+        selection = LineSelection(self.selected_lines())
+        patch = parse_diff(result).partial_patch(selection, direct=direct_select)
+        if patch:
+            self.apply_patch(patch, edit_patch, **kwargs)
+        else:
+            sublime.status_message("No selected lines")
+
 # Also, sometimes we want to undo adds
 
 
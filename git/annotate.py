@@ -1,26 +1,80 @@
 from __future__ import absolute_import, unicode_literals, print_function, division
 
-import tempfile
-import re
+import functools
 import os
-import codecs
+import traceback
 
 import sublime
 import sublime_plugin
-from . import git_root, GitTextCommand
+from . import git_root, GitTextCommand, view_contents
+from .add import GitAddSelectedHunkCommand
+from .linediff import classify, opcodes, split_lines, update_opcodes
+from .objects import head_oid
 
 
-def temp_file(view, key):
-    if not view.settings().get('git_annotation_temp_%s' % key, False):
-        fd, filepath = tempfile.mkstemp(prefix='git_annotations_')
-        os.close(fd)
-        view.settings().set('git_annotation_temp_%s' % key, filepath)
-    return view.settings().get('git_annotation_temp_%s' % key)
+class AnnotationState(object):
+    # Bookkeeping for one view's live annotations. generation goes up with
+    # every modification, so a result can tell whether the buffer it was
+    # computed from is still the current one.
+    # snapshot is the last comparison made: (head text, head lines, buffer
+    # lines, opcodes between them), which the next run can update rather
+    # than starting over; snapshot_key is the (generation, HEAD commit) it
+    # was made for. regions holds the spans last drawn for each change
+    # type, so unchanged ones needn't be drawn again.
+    def __init__(self):
+        self.generation = 0
+        self.running = False
+        self.pending = False
+        self.snapshot = None
+        self.snapshot_key = None
+        self.regions = {}
+
+
+annotation_states = {}
+annotation_stats = {'edits': 0, 'runs': 0, 'dropped': 0}
+
+# Removed lines are marked by underlining the line above. Where the whole line
+# can be underlined as one region, do that rather than an empty region per
+# character.
+if hasattr(sublime, 'DRAW_SOLID_UNDERLINE'):
+    DELETION_FLAGS = sublime.DRAW_NO_FILL | sublime.DRAW_NO_OUTLINE | sublime.DRAW_SOLID_UNDERLINE
+else:
+    DELETION_FLAGS = None
+
+
+def annotation_state(view):
+    return annotation_states.setdefault(view.id(), AnnotationState())
+
+
+def strip_crs(text):
+    # The buffer's lines end in "\n" whatever the file's do, so HEAD's are
+    # compared the same way
+    return text.replace('\r\n', '\n')
+
+
+def annotation_spans(diff):
+    # Runs of consecutive lines with the same change type, as [first, last]
+    spans = {'x': [], '+': [], '-': []}
+    for change_type, line in diff:
+        typed = spans[change_type]
+        if typed and typed[-1][1] == line - 1:
+            typed[-1][1] = line
+        else:
+            typed.append([line, line])
+    return spans
+
+
+def forget_regions(view):
+    # after this the next annotation draws every change type afresh
+    state = annotation_states.get(view.id())
+    if state is not None:
+        state.regions = {}
 
 
 class GitClearAnnotationCommand(GitTextCommand):
     def run(self, view):
         self.active_view().settings().set('live_git_annotations', False)
+        forget_regions(self.view)
         self.view.erase_regions('git.changes.x')
         self.view.erase_regions('git.changes.+')
         self.view.erase_regions('git.changes.-')
@@ -34,150 +88,381 @@ class GitToggleAnnotationsCommand(GitTextCommand):
             self.view.run_command('git_annotate')
 
 
+class GitAnnotationStatsCommand(GitTextCommand):
+    def run(self, view):
+        stats = annotation_stats
+        sublime.status_message("Git annotations: %d edits, %d runs (%d saved), %d stale results dropped" % (
+            stats['edits'], stats['runs'], max(0, stats['edits'] - stats['runs']), stats['dropped']))
+
+
 class GitAnnotationListener(sublime_plugin.EventListener):
+    # Rather than annotating on every keystroke, wait until the view has been
+    # left alone for annotation_delay milliseconds.
     def on_modified(self, view):
         if not view.settings().get('live_git_annotations'):
             return
+        state = annotation_state(view)
+        state.generation += 1
+        annotation_stats['edits'] += 1
+        s = sublime.load_settings("Git.sublime-settings")
+        sublime.set_timeout(functools.partial(self.idle, view, state.generation), s.get('annotation_delay', 250))
+
+    def idle(self, view, generation):
+        state = annotation_states.get(view.id())
+        if state is None or state.generation != generation:
+            # closed, or edited again since
+            return
         view.run_command('git_annotate')
 
+    def on_close(self, view):
+        annotation_states.pop(view.id(), None)
+
+    def on_revert(self, view):
+        forget_regions(view)
+
+    def on_reload(self, view):
+        forget_regions(view)
+
     def on_load(self, view):
+        forget_regions(view)
         s = sublime.load_settings("Git.sublime-settings")
         if s.get('annotations'):
             view.run_command('git_annotate')
 
 
 class GitAnnotateCommand(GitTextCommand):
-    # Unfortunately, git diff does not support text from stdin, making a *live*
-    # annotation difficult. Therefore I had to resort to the system diff
-    # command.
-    # This works as follows:
-    # 1. When the command is run for the first time for this file, a temporary
-    #    file with the current state of the HEAD is being pulled from git.
-    # 2. All consecutive runs will pass the current buffer into diffs stdin.
-    #    The resulting output is then parsed and regions are set accordingly.
+    # Live annotation compares the buffer against the file as it is in HEAD:
+    # 1. The HEAD version comes from the shared blob cache, or failing that
+    #    the repository's cat-file process.
+    # 2. The buffer and that are diffed in-process (see linediff), off the
+    #    main thread, and the changed lines become regions.
+    # Only one run per view is in flight at a time; asking for another while
+    # one is going just makes sure there's a fresh run when it finishes. Each
+    # run carries the view's generation, and its result is thrown away if the
+    # buffer has changed since.
     may_change_files = False
 
     def run(self, view):
-        # If the annotations are already running, we dont have to create a new
-        # tmpfile
-        if not hasattr(self, "git_tmp"):
-            self.git_tmp = temp_file(self.active_view(), 'head')
-            self.buffer_tmp = temp_file(self.active_view(), 'buffer')
         self.active_view().settings().set('live_git_annotations', True)
-        root = git_root(self.get_working_dir())
-        repo_file = os.path.relpath(self.view.file_name(), root).replace('\\', '/')  # always unix
-        self.run_command(['git', 'show', 'HEAD:{0}'.format(repo_file)], show_status=False, no_save=True, callback=self.compare_tmp)
-
-    def compare_tmp(self, result, stdout=None):
-        with open(self.buffer_tmp, 'wb') as f:
-            contents = self.get_view_contents()
-            if self.view.encoding() == "UTF-8 with BOM":
-                f.write(codecs.BOM_UTF8)
-            f.write(contents)
-        with open(self.git_tmp, 'wb') as f:
-            f.write(result.encode())
-        self.run_command(['git', 'diff', '-u', '--', self.git_tmp, self.buffer_tmp], no_save=True, show_status=False, callback=self.parse_diff)
-
-    # This is where the magic happens. At the moment, only one chunk format is supported. While
-    # the unified diff format theoritaclly supports more, I don't think git diff creates them.
-    def parse_diff(self, result, stdin=None):
-        if result.startswith('error:'):
-            print('Aborted annotations:', result)
+        state = annotation_state(self.view)
+        if state.running:
+            state.pending = True
             return
-        lines = result.splitlines()
-        matcher = re.compile('^@@ -([0-9]*),([0-9]*) \+([0-9]*),([0-9]*) @@')
-        diff = []
-        for line_index in range(0, len(lines)):
-            line = lines[line_index]
-            if not line.startswith('@'):
-                continue
-            match = matcher.match(line)
-            if not match:
-                continue
-            line_before, len_before, line_after, len_after = [int(match.group(x)) for x in [1, 2, 3, 4]]
-            chunk_index = line_index + 1
-            tracked_line_index = line_after - 1
-            deletion = False
-            insertion = False
-            while True:
-                line = lines[chunk_index]
-                if line.startswith('@'):
-                    break
-                elif line.startswith('-'):
-                    if not line.strip() == '-':
-                        deletion = True
-                    tracked_line_index -= 1
-                elif line.startswith('+'):
-                    if deletion and not line.strip() == '+':
-                        diff.append(['x', tracked_line_index])
-                        insertion = True
-                    elif not deletion:
-                        insertion = True
-                        diff.append(['+', tracked_line_index])
-                else:
-                    if not insertion and deletion:
-                        diff.append(['-', tracked_line_index])
-                    insertion = deletion = False
-                tracked_line_index += 1
-                chunk_index += 1
-                if chunk_index >= len(lines):
-                    break
+        state.running = True
+        state.pending = False
+        annotation_stats['runs'] += 1
+        try:
+            root = git_root(self.get_working_dir())
+            repo_file = os.path.relpath(self.view.file_name(), root).replace('\\', '/')  # always unix
+            self.read_blob('HEAD', repo_file, self.compare_head, background=True, generation=state.generation, head=head_oid(root))
+        except Exception:
+            # nothing is on its way to clear it, and annotating would stop for good
+            state.running = False
+            raise
 
-        self.annotate(diff)
+    def compare_head(self, result, generation, head):
+        if self.is_stale(generation):
+            return self.finish()
+        if result is None:
+            # not in HEAD yet, so every line is new
+            result = ''
+        contents = view_contents(self.view)
+        if self.view.encoding() == "UTF-8 with BOM":
+            contents = '\ufeff' + contents
+        snapshot = annotation_state(self.view).snapshot
+        self.run_in_background(self.compare, self.annotate, result, contents, snapshot, generation=generation, head=head)
+
+    def compare(self, head, contents, snapshot):
+        # If HEAD is what it was last time, only the part of the buffer that
+        # has changed since needs diffing again
+        try:
+            lines = split_lines(contents)
+            if snapshot and snapshot[0] == head:
+                head_lines = snapshot[1]
+                codes = update_opcodes(head_lines, snapshot[2], lines, snapshot[3])
+            else:
+                head_lines = split_lines(strip_crs(head))
+                codes = opcodes(head_lines, lines)
+            return (head, head_lines, lines, codes), classify(head_lines, lines, codes)
+        except Exception:
+            traceback.print_exc()
+
+    def is_stale(self, generation):
+        state = annotation_states.get(self.view.id())
+        if state is not None and state.generation == generation and self.view.settings().get('live_git_annotations'):
+            return False
+        annotation_stats['dropped'] += 1
+        return True
+
+    def finish(self):
+        state = annotation_states.get(self.view.id())
+        if state is None:
+            # the view was closed
+            return
+        state.running = False
+        if state.pending and self.view.settings().get('live_git_annotations'):
+            self.view.run_command('git_annotate')
 
     # Once we got all lines with their specific change types (either x, +, or - for
     # modified, added, or removed) we can create our regions and do the actual annotation.
-    def annotate(self, diff):
-        self.view.erase_regions('git.changes.x')
-        self.view.erase_regions('git.changes.+')
-        self.view.erase_regions('git.changes.-')
-        typed_diff = {'x': [], '+': [], '-': []}
-        for change_type, line in diff:
+    def annotate(self, result, generation, head):
+        self.finish()
+        if result is None:
+            return
+        snapshot, diff = result
+        state = annotation_states.get(self.view.id())
+        if state is not None:
+            # still a true comparison even if the buffer has moved on since
+            state.snapshot = snapshot
+            state.snapshot_key = (generation, head)
+        if self.is_stale(generation):
+            return
+        # Each change type is only redrawn if its lines differ from last time;
+        # regions already in the view move along with edits by themselves.
+        for change_type, spans in annotation_spans(diff).items():
+            if state.regions.get(change_type) == spans:
+                continue
+            state.regions[change_type] = spans
+            key = 'git.changes.{0}'.format(change_type)
             if change_type == '-':
-                full_region = self.view.full_line(self.view.text_point(line - 1, 0))
-                position = full_region.begin()
-                for i in range(full_region.size()):
-                    typed_diff[change_type].append(sublime.Region(position + i))
+                regions, flags = self.deletion_regions(spans)
             else:
-                point = self.view.text_point(line, 0)
+                regions, flags = self.change_regions(spans), sublime.HIDDEN
+            self.view.add_regions(key, regions, key, 'dot', flags)
+
+    def change_regions(self, spans):
+        # One region per line rather than per span, so every line gets its
+        # gutter icon
+        regions = []
+        for first, last in spans:
+            point = self.view.text_point(first, 0)
+            for line in range(first, last + 1):
                 region = self.view.full_line(point)
-                if change_type == '-':
-                    region = sublime.Region(point, point + 5)
-                typed_diff[change_type].append(region)
+                regions.append(region)
+                point = region.end()
+        return regions
 
-        for change in ['x', '+']:
-            self.view.add_regions("git.changes.{0}".format(change), typed_diff[change], 'git.changes.{0}'.format(change), 'dot', sublime.HIDDEN)
+    def deletion_regions(self, spans):
+        regions = []
+        for first, last in spans:
+            for line in range(first, last + 1):
+                full_region = self.view.full_line(self.view.text_point(line - 1, 0))
+                if DELETION_FLAGS is not None:
+                    regions.append(full_region)
+                else:
+                    position = full_region.begin()
+                    regions.extend(sublime.Region(position + i) for i in range(full_region.size()))
+        if DELETION_FLAGS is not None:
+            return regions, DELETION_FLAGS
+        return regions, sublime.DRAW_EMPTY_AS_OVERWRITE
 
-        self.view.add_regions("git.changes.-", typed_diff['-'], 'git.changes.-', 'dot', sublime.DRAW_EMPTY_AS_OVERWRITE)
 
-    def get_view_contents(self):
-        region = sublime.Region(0, self.view.size())
-        try:
-            contents = self.view.substr(region).encode(self._get_view_encoding())
-        except UnicodeError:
-            # Fallback to utf8-encoding
-            contents = self.view.substr(region).encode('utf-8')
-        except LookupError:
-            # May encounter an encoding we don't have a codec for
-            contents = self.view.substr(region).encode('utf-8')
-        return contents
-
-    # Copied from GitGutter
-    def _get_view_encoding(self):
-        # get encoding and clean it for python ex: "Western (ISO 8859-1)"
-        # NOTE(maelnor): are we need regex here?
-        pattern = re.compile(r'.+\((.*)\)')
-        encoding = self.view.encoding()
-        if encoding == "Undefined":
-            encoding = self.view.settings().get('default_encoding')
-        if pattern.match(encoding):
-            encoding = pattern.sub(r'\1', encoding)
-
-        encoding = encoding.replace('with BOM', '')
-        encoding = encoding.replace('Windows', 'cp')
-        encoding = encoding.replace('-', '_')
-        encoding = encoding.replace(' ', '')
-
-        # work around with ConvertToUTF8 plugin
-        origin_encoding = self.view.settings().get('origin_encoding')
-        return origin_encoding or encoding
+def current_snapshot(view, root):
+    # The view's last annotation snapshot, if it's still true of the buffer
+    # and of HEAD
+    state = annotation_states.get(view.id())
+    if state is None or state.snapshot is None or not view.settings().get('live_git_annotations'):
+        return None
+    if state.snapshot_key != (state.generation, head_oid(root)):
+        return None
+    return state.snapshot
+
+
+def selected_rows(view):
+    return [(view.rowcol(sel.begin())[0], view.rowcol(sel.end())[0]) for sel in view.sel()]
+
+
+def touched_changes(codes, rows):
+    # The indexes of the opcodes for changes that any of the (first, last)
+    # buffer rows touch; a removal is touched from the row either side of it
+    return [index for index, code in enumerate(codes) if code[0] != 'equal' and any(
+        first <= max(code[3], code[4] - 1) and last >= code[3] - (1 if code[3] == code[4] else 0)
+        for first, last in rows)]
+
+
+def change_patch(snapshot, path, rows, context=1):
+    """A patch of HEAD against the buffer for just the changes rows touch.
+
+    snapshot is an AnnotationState's, path the file's path in the
+    repository, and rows the (first, last) buffer rows selected, 0-based.
+    A removal is touched by a row just above or below it. Changes with no
+    more than context * 2 unchanged lines between them go in one hunk.
+    Returns '' if no change is touched, and None if HEAD's copy mixes line
+    endings, as there's no telling which the buffer's lines should have.
+    """
+    head, head_lines, lines, codes = snapshot
+    changes = touched_changes(codes, rows)
+    if not changes:
+        return ''
+    # the lines were compared without their "\r"s; the patch needs them back
+    crlfs = head.count('\r\n')
+    if crlfs and crlfs != head.count('\n'):
+        return None
+    eol = '\r\n' if crlfs else '\n'
+
+    # group the chosen changes into hunks, as runs of opcodes
+    groups = []
+    for index in changes:
+        if groups and index == groups[-1][1] + 2 and codes[index - 1][2] - codes[index - 1][1] <= context * 2:
+            groups[-1][1] = index
+        else:
+            groups.append([index, index])
+
+    parts = ['diff --git a/%s b/%s\n--- a/%s\n+++ b/%s\n' % (path, path, path, path)]
+    offset = 0
+    for first, last in groups:
+        # context only from the unchanged lines either side
+        i1 = max(codes[first - 1][1] if first else 0, codes[first][1] - context)
+        i2 = min(codes[last + 1][2] if last + 1 < len(codes) else len(head_lines), codes[last][2] + context)
+        body = []
+        old_count = new_count = 0
+        for tag, a1, a2, b1, b2 in codes[first:last + 1]:
+            if tag == 'equal':
+                body.extend(' ' + line for line in head_lines[a1:a2])
+                old_count += a2 - a1
+                new_count += a2 - a1
+            else:
+                body.extend('-' + line for line in head_lines[a1:a2])
+                body.extend('+' + line for line in lines[b1:b2])
+                old_count += a2 - a1
+                new_count += b2 - b1
+        before = [' ' + line for line in head_lines[i1:codes[first][1]]]
+        after = [' ' + line for line in head_lines[codes[last][2]:i2]]
+        old_count += len(before) + len(after)
+        new_count += len(before) + len(after)
+        # an empty side is numbered by the line before it
+        old_start = i1 + 1 if old_count else i1
+        new_start = i1 + offset + 1 if new_count else i1 + offset
+        parts.append('@@ -%d,%d +%d,%d @@\n' % (old_start, old_count, new_start, new_count))
+        for line in before + body + after:
+            if line.endswith('\n'):
+                parts.append(line[:-1] + eol)
+            else:
+                parts.append(line + '\n\\ No newline at end of file\n')
+        offset += new_count - old_count
+    return ''.join(parts)
+
+
+class GitStageChangeCommand(GitAddSelectedHunkCommand):
+    # Stages the changes the selection touches, with the patch made from what
+    # live annotations last compared, so no `git diff` has to run first. If
+    # that's out of date, or the patch doesn't apply because the index has
+    # moved on from HEAD, it does what Add Selected Hunk does instead.
+    apply_options = ['--cached']
+
+    def run(self, edit):
+        patch = self.annotation_patch()
+        if not patch:
+            return self.fall_back()
+        root = git_root(self.get_working_dir())
+        self.run_command(['git', 'apply'] + self.apply_options, self.applied, stdin=patch, working_dir=root)
+
+    def annotation_patch(self):
+        view = self.view
+        root = git_root(self.get_working_dir())
+        snapshot = current_snapshot(view, root)
+        if snapshot is None or view.is_dirty():
+            return None
+        path = os.path.relpath(view.file_name(), root).replace('\\', '/')
+        return change_patch(snapshot, path, selected_rows(view))
+
+    def applied(self, result, **kwargs):
+        if result.strip():
+            return self.fall_back()
+        sublime.status_message("Staged")
+
+    def fall_back(self):
+        super(GitStageChangeCommand, self).run(None)
+
+
+class GitUnstageChangeCommand(GitStageChangeCommand):
+    # The same patch, taken back out of the index. The change has to be
+    # staged as it is in the buffer for that to apply; if it isn't, the
+    # fallback works from `git diff --cached` instead.
+    apply_options = ['--cached', '-R']
+
+    def applied(self, result, **kwargs):
+        if result.strip():
+            return self.fall_back()
+        sublime.status_message("Unstaged")
+
+    def fall_back(self):
+        self.run_command(['git', 'diff', '--cached', '--no-color', '-U1', self.get_file_name()], self.cull_diff)
+
+    def on_input(self, patch, **kwargs):
+        self.run_command(['git', 'apply'] + self.apply_options, stdin=patch, **kwargs)
+
+
+class GitRevertChangeCommand(GitTextCommand):
+    # Puts the changes the selection touches back the way they are in HEAD,
+    # by replacing just those lines of the buffer; the file isn't touched
+    # until it's saved, and it's one step to undo. The HEAD lines come from
+    # live annotations' last comparison if it's current, and otherwise from
+    # comparing with HEAD's copy in the blob cache now.
+    may_change_files = False
+
+    def run(self, edit, reversions=None, change_count=None):
+        view = self.view
+        if reversions is not None:
+            # from a comparison just made; only good if nothing's changed since
+            if change_count != view.change_count():
+                sublime.status_message("The file changed while it was being compared; try again")
+                return
+            return self.revert(edit, reversions)
+        root = git_root(self.get_working_dir())
+        snapshot = current_snapshot(view, root)
+        if snapshot is not None:
+            return self.revert(edit, self.reversions(snapshot[1:], selected_rows(view)))
+        path = os.path.relpath(view.file_name(), root).replace('\\', '/')
+        self.read_blob('HEAD', path, self.head_read, rows=selected_rows(view), change_count=view.change_count())
+
+    def head_read(self, result, rows, change_count):
+        if change_count != self.view.change_count():
+            return
+        if result is None:
+            sublime.status_message("Not in HEAD")
+            return
+        contents = view_contents(self.view)
+        if self.view.encoding() == "UTF-8 with BOM":
+            contents = '\ufeff' + contents
+        self.run_in_background(self.compare, self.compared, result, contents, rows=rows, change_count=change_count)
+
+    def compare(self, head, contents):
+        head_lines = split_lines(strip_crs(head))
+        lines = split_lines(contents)
+        return head_lines, lines, opcodes(head_lines, lines)
+
+    def compared(self, comparison, rows, change_count):
+        if comparison is None:
+            sublime.status_message("Couldn't compare with HEAD")
+            return
+        self.view.run_command('git_revert_change', {
+            'reversions': self.reversions(comparison, rows),
+            'change_count': change_count,
+        })
+
+    def reversions(self, comparison, rows):
+        # [first row, end row or None for the end of the buffer, HEAD's text]
+        # for each change touched
+        head_lines, lines, codes = comparison
+        reversions = []
+        for index in touched_changes(codes, rows):
+            tag, i1, i2, j1, j2 = codes[index]
+            text = ''.join(head_lines[i1:i2])
+            if i1 == 0 and self.view.encoding() == "UTF-8 with BOM":
+                # the buffer doesn't show it
+                text = text.lstrip('\ufeff')
+            reversions.append([j1, j2 if j2 < len(lines) else None, text])
+        return reversions
+
+    def revert(self, edit, reversions):
+        view = self.view
+        if not reversions:
+            sublime.status_message("No change at the cursor")
+            return
+        # from the bottom up, so rows above stay where they were
+        for first, end, text in sorted(reversions, reverse=True, key=lambda reversion: reversion[0]):
+            begin = view.text_point(first, 0) if first < view.rowcol(view.size())[0] + 1 else view.size()
+            region = sublime.Region(begin, view.size() if end is None else view.text_point(end, 0))
+            view.replace(edit, region, text)
+        sublime.status_message("Reverted %d change%s" % (len(reversions), '' if len(reversions) == 1 else 's'))
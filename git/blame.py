@@ -0,0 +1,379 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import functools
+import time
+
+import sublime
+import sublime_plugin
+from . import GitTextCommand, git_root, view_contents
+from .commits import relative_date
+from .objects import LRUCache, blob_oid, head_oid
+
+
+# Reading `git blame --incremental` as it streams in, and putting the result
+# back together the way plain `git blame` would print it.
+
+
+class BlameCommit(object):
+    __slots__ = ('sha', 'author', 'author_mail', 'author_time', 'author_tz', 'summary', 'boundary')
+
+    def __init__(self, sha):
+        self.sha = sha
+        self.author = ''
+        self.author_mail = ''
+        self.author_time = 0
+        self.author_tz = '+0000'
+        self.summary = ''
+        self.boundary = False
+
+    @property
+    def uncommitted(self):
+        return not self.sha.strip('0')
+
+    def short_sha(self):
+        # blame's default: 8 characters, or '^' and 7 for a boundary commit
+        if self.boundary:
+            return '^' + self.sha[:7]
+        return self.sha[:8]
+
+    def date(self):
+        # --date=iso, in the author's timezone
+        tz = self.author_tz
+        try:
+            offset = (int(tz[1:3]) * 60 + int(tz[3:5])) * 60 * (-1 if tz[0] == '-' else 1)
+        except (ValueError, IndexError):
+            offset = 0
+        return time.strftime('%Y-%m-%d %H:%M:%S ', time.gmtime(self.author_time + offset)) + tz
+
+
+class Blame(object):
+    """Who last touched each line of a file, as far as it's been worked out.
+
+    lines maps a (1-based) line number to a (commit, original line number,
+    original file name) tuple.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.commits = {}
+        self.lines = {}
+        self.errors = []
+
+    def __len__(self):
+        return len(self.lines)
+
+    def commit(self, sha):
+        commit = self.commits.get(sha)
+        if commit is None:
+            commit = self.commits[sha] = BlameCommit(sha)
+        return commit
+
+    def add(self, commit, orig_line, final_line, count, filename):
+        for i in range(count):
+            self.lines[final_line + i] = (commit, orig_line + i, filename)
+
+    def render(self, text_lines, line_numbers=None, unblamed=False):
+        """The blame as `git blame` (with no options) prints it.
+
+        text_lines are the file's lines; line_numbers picks the ones to show,
+        by default every line that has been blamed. With unblamed set, lines
+        not blamed yet are shown too, with their blame left blank, so that
+        every line is already where it will end up.
+        """
+        if line_numbers is None:
+            line_numbers = sorted(self.lines)
+        entries = [(number, self.lines.get(number)) for number in line_numbers]
+        known = [entry for number, entry in entries if entry is not None]
+        if not known:
+            return ''
+        # like git, show where lines came from only if that isn't always here
+        show_name = any(filename != self.path for commit, orig_line, filename in known)
+        name_width = max(len(filename) for commit, orig_line, filename in known)
+        author_width = max(len(commit.author) for commit, orig_line, filename in known)
+        number_width = len(str(max(line_numbers)))
+
+        def prefix(commit, filename, number):
+            return '%s %s(%s %s %*d)' % (
+                commit.short_sha(),
+                filename.ljust(name_width) + ' ' if show_name else '',
+                commit.author.ljust(author_width), commit.date(),
+                number_width, number)
+        # every prefix is the same width; an unblamed line's is blank up to
+        # the line number
+        commit, orig_line, filename = known[0]
+        blank = ' ' * (len(prefix(commit, filename, 0)) - number_width - 1)
+        output = []
+        for number, entry in entries:
+            text = text_lines[number - 1] if number <= len(text_lines) else ''
+            if entry is not None:
+                commit, orig_line, filename = entry
+                output.append(prefix(commit, filename, number) + ' ' + text)
+            elif unblamed:
+                output.append('%s%*d) %s' % (blank, number_width, number, text))
+        return '\n'.join(output) + '\n'
+
+
+class BlameParser(object):
+    # Feed it `git blame --incremental` output in whatever pieces it arrives in
+    def __init__(self, blame):
+        self.blame = blame
+        self.partial = ''
+        self.hunk = None
+
+    def feed(self, text):
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.line(line)
+
+    def close(self):
+        if self.partial:
+            self.line(self.partial)
+            self.partial = ''
+
+    def line(self, line):
+        if self.hunk is None:
+            parts = line.split(' ')
+            if len(parts) == 4 and len(parts[0]) >= 40:
+                try:
+                    self.hunk = (self.blame.commit(parts[0]), int(parts[1]), int(parts[2]), int(parts[3]))
+                    return
+                except ValueError:
+                    pass
+            if line.strip():
+                # stderr comes through the same way
+                self.blame.errors.append(line)
+            return
+        commit = self.hunk[0]
+        key, _, value = line.partition(' ')
+        if key == 'filename':
+            # the last line of every hunk
+            self.blame.add(commit, self.hunk[1], self.hunk[2], self.hunk[3], value)
+            self.hunk = None
+        elif key == 'author':
+            commit.author = value
+        elif key == 'author-mail':
+            commit.author_mail = value
+        elif key == 'author-time':
+            commit.author_time = int(value)
+        elif key == 'author-tz':
+            commit.author_tz = value
+        elif key == 'summary':
+            commit.summary = value
+        elif key == 'boundary':
+            commit.boundary = True
+
+
+# Finished blames, by (root, path, HEAD, blob oid of the file, options); if
+# none of those have changed, nor has the answer.
+blames = LRUCache(max_entries=32)
+
+
+# Inline blame: the lines on screen in the active view get who last changed
+# them shown alongside, blamed a screenful at a time with -L as you scroll.
+
+def uncovered(first, last, ranges):
+    # The parts of [first, last] that aren't in any of ranges
+    missing = []
+    for start, end in sorted(ranges):
+        if end < first:
+            continue
+        if start > last:
+            break
+        if start > first:
+            missing.append([first, start - 1])
+        first = max(first, end + 1)
+    if first <= last:
+        missing.append([first, last])
+    return missing
+
+
+class InlineBlame(object):
+    # The blame of one version of a file, filled in as ranges of it are asked
+    # for. covered are the [first, last] ranges done; requests are the
+    # (command thread, ranges) on the way.
+    def __init__(self, path):
+        self.blame = Blame(path)
+        self.covered = []
+        self.requests = []
+
+    def __len__(self):
+        return len(self.blame)
+
+    def done(self, ranges):
+        # even if git couldn't blame them, there's no point asking again
+        self.requests = [request for request in self.requests if request[1] is not ranges]
+        self.covered.extend(ranges)
+
+    def missing(self, first, last):
+        # A command that finished without calling back (its working
+        # directory went, say) won't ever; its ranges are as done as they'll get
+        for thread, ranges in self.requests:
+            if thread.finished:
+                self.done(ranges)
+        pending = [line_range for thread, ranges in self.requests for line_range in ranges]
+        return uncovered(first, last, self.covered + pending)
+
+
+# By (root, path, HEAD, blob oid of the buffer), like blames
+inline_blames = LRUCache(max_entries=16)
+
+
+class InlineBlameState(object):
+    # What one view last showed. oid is worked out from the buffer only when
+    # its change_count has moved on and then stayed put for a while.
+    def __init__(self):
+        self.change_count = None
+        self.changed = 0
+        self.oid = None
+        self.drawn = None
+        self.phantoms = None
+        self.polling = False
+
+
+inline_blame_states = {}
+
+# How often to look at where the view has scrolled to, and how long after
+# the last edit to wait before blaming the buffer again, in milliseconds; and
+# how many lines beyond the visible ones to blame while at it
+INLINE_BLAME_INTERVAL = 300
+INLINE_BLAME_QUIET = 1000
+INLINE_BLAME_MARGIN = 20
+
+
+def escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def inline_label(commit):
+    if commit.uncommitted:
+        return "You, uncommitted"
+    return "%s, %s \u2022 %s (%s)" % (commit.author, relative_date(commit.author_time), commit.summary, commit.sha[:7])
+
+
+class GitInlineBlameCommand(GitTextCommand):
+    def run(self, edit):
+        view = self.view
+        state = inline_blame_states.setdefault(view.id(), InlineBlameState())
+        now = time.time()
+        if state.change_count != view.change_count():
+            state.change_count = view.change_count()
+            state.changed = now
+            state.oid = None
+            return
+        contents = None
+        if state.oid is None:
+            # wait for typing to stop before reading (and hashing) the
+            # buffer to blame what's been typed
+            if now - state.changed < INLINE_BLAME_QUIET / 1000:
+                return
+            contents = view_contents(view)
+            state.oid = blob_oid(contents.encode('utf-8'))
+
+        root = git_root(self.get_working_dir())
+        path = self.get_relative_file_path()
+        key = (root, path, head_oid(root), state.oid)
+        entry = inline_blames.get(key)
+        if entry is None:
+            entry = InlineBlame(path)
+            inline_blames.set(key, entry)
+
+        visible = view.visible_region()
+        lines = view.rowcol(view.size())[0] + 1
+        first = max(1, view.rowcol(visible.begin())[0] + 1 - INLINE_BLAME_MARGIN)
+        last = min(lines, view.rowcol(visible.end())[0] + 1 + INLINE_BLAME_MARGIN)
+        missing = entry.missing(first, last)
+        if missing:
+            # Blame the buffer rather than the file, so the lines line up
+            # even when it hasn't been saved
+            parser = BlameParser(entry.blame)
+            command = ['git', 'blame', '--incremental', '-w', '--contents', '-']
+            for start, end in missing:
+                command.extend(('-L', '%d,%d' % (start, end)))
+            command.extend(('--', self.get_file_name()))
+            thread = self.run_command(
+                command, self.blamed, stream=parser.feed, show_status=False, no_save=True,
+                background=True, stdin=contents if contents is not None else view_contents(view),
+                entry=entry, ranges=missing, parser=parser)
+            entry.requests.append((thread, missing))
+        self.draw(state, key, entry, first, last)
+
+    def blamed(self, result, entry, ranges, parser, **kwargs):
+        parser.close()
+        entry.done(ranges)
+        if self.view.settings().get('git_inline_blame'):
+            self.view.run_command('git_inline_blame')
+
+    def draw(self, state, key, entry, first, last):
+        view = self.view
+        lines = entry.blame.lines
+        if not hasattr(sublime, 'PhantomSet'):
+            # Sublime Text before 3118: just the line with the cursor, in the status bar
+            row = view.rowcol(view.sel()[0].begin())[0] + 1 if len(view.sel()) else 0
+            view.set_status('git-blame', inline_label(lines[row][0]) if row in lines else '')
+            return
+        drawn = (key, first, last, len(entry))
+        if drawn == state.drawn:
+            return
+        state.drawn = drawn
+        if state.phantoms is None:
+            state.phantoms = sublime.PhantomSet(view, 'git_inline_blame')
+        phantoms = []
+        for number in range(first, last + 1):
+            if number not in lines:
+                continue
+            line = view.line(view.text_point(number - 1, 0))
+            html = '<span style="color: color(var(--foreground) alpha(0.5))">&nbsp;&nbsp;&nbsp;%s</span>' % escape(inline_label(lines[number][0]))
+            phantoms.append(sublime.Phantom(sublime.Region(line.end()), html, sublime.LAYOUT_INLINE))
+        state.phantoms.update(phantoms)
+
+
+class GitToggleInlineBlameCommand(GitTextCommand):
+    def run(self, edit):
+        settings = self.view.settings()
+        if settings.get('git_inline_blame'):
+            settings.set('git_inline_blame', False)
+            clear_inline_blame(self.view)
+        else:
+            settings.set('git_inline_blame', True)
+            poll_inline_blame(self.view)
+
+
+def clear_inline_blame(view):
+    state = inline_blame_states.pop(view.id(), None)
+    if state is not None and state.phantoms is not None:
+        state.phantoms.update([])
+    view.erase_status('git-blame')
+
+
+def poll_inline_blame(view):
+    # Scrolling doesn't raise any event, so while the view's active, keep
+    # looking; each look is cheap unless something's changed.
+    state = inline_blame_states.get(view.id())
+    if state is None:
+        state = inline_blame_states[view.id()] = InlineBlameState()
+        # nothing to wait for to begin with
+        state.change_count = view.change_count()
+    if state.polling:
+        return
+    state.polling = True
+    inline_blame_tick(view, state)
+
+
+def inline_blame_tick(view, state):
+    window = view.window()
+    active = window.active_view() if window is not None else None
+    current = inline_blame_states.get(view.id()) is state and view.settings().get('git_inline_blame')
+    if not current or active is None or active.id() != view.id():
+        state.polling = False
+        return
+    view.run_command('git_inline_blame')
+    sublime.set_timeout(functools.partial(inline_blame_tick, view, state), INLINE_BLAME_INTERVAL)
+
+
+class GitInlineBlameListener(sublime_plugin.EventListener):
+    def on_activated(self, view):
+        if view.settings().get('git_inline_blame'):
+            poll_inline_blame(view)
+
+    def on_close(self, view):
+        inline_blame_states.pop(view.id(), None)
@@ -9,6 +9,7 @@ import sublime
 import sublime_plugin
 from . import GitTextCommand, GitWindowCommand, plugin_file, view_contents, _make_text_safeish
 from .add import GitAddSelectedHunkCommand
+from .porcelain import parse_status
 
 history = []
 
@@ -52,7 +53,7 @@ class GitQuickCommitCommand(GitTextCommand):
 # -w to sublime, which means the editor won't wait, and so the commit will fail
 # with an empty message.
 # Thus this flow:
-# 1. `status --porcelain --untracked-files=no` to know whether files need
+# 1. `status --porcelain=v2 --untracked-files=no` to know whether files need
 #    to be committed
 # 2. `status` to get a template commit message (not the exact one git uses; I
 #    can't see a way to ask it to output that, which is not quite ideal)
@@ -73,18 +74,12 @@ class GitCommitCommand(GitWindowCommand):
         self.lines = []
         self.working_dir = self.get_working_dir()
         self.run_command(
-            ['git', 'status', '--untracked-files=no', '--porcelain'],
+            ['git', 'status', '--untracked-files=no', '--porcelain=v2', '-z'],
             self.porcelain_status_done
         )
 
     def porcelain_status_done(self, result):
-        # todo: split out these status-parsing things... asdf
-        has_staged_files = False
-        result_lines = result.rstrip().split('\n')
-        for line in result_lines:
-            if line and not line[0].isspace():
-                has_staged_files = True
-                break
+        has_staged_files = any(entry.index != ' ' for entry in parse_status(result))
         if not has_staged_files and self.quit_when_nothing_staged:
             self.panel("Nothing to commit")
             return
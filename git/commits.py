@@ -0,0 +1,331 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+
+import sublime
+from . import CommandThread, CommandScheduler, scheduler, lane_size, git_binary, main_thread
+from .objects import head_oid
+
+
+# What's kept for each commit. Subjects can't have newlines and nothing in a
+# commit can have a NUL, so records are NUL-separated fields, one per line.
+RECORD_FORMAT = '--format=%H%x00%an%x00%aE%x00%at%x00%s'
+
+DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+class CommitInfo(object):
+    __slots__ = ('oid', 'author', 'email', 'time', 'subject')
+
+    def __init__(self, oid, author, email, time, subject):
+        self.oid = oid
+        self.author = author
+        self.email = email
+        self.time = time
+        self.subject = subject
+
+    @classmethod
+    def parse(cls, line):
+        fields = line.rstrip('\n').split('\0')
+        if len(fields) != 5 or len(fields[0]) < 40:
+            return None
+        try:
+            return cls(fields[0], fields[1], fields[2], int(fields[3]), fields[4])
+        except ValueError:
+            return None
+
+    def date(self):
+        # as --date=local shows it
+        t = time.localtime(self.time)
+        return '%s %s %d %02d:%02d:%02d %d' % (DAYS[t.tm_wday], MONTHS[t.tm_mon - 1], t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, t.tm_year)
+
+    def relative_date(self, now=None):
+        return relative_date(self.time, now)
+
+
+def plural(n, one, many):
+    return (one if n == 1 else many) % n
+
+
+def relative_date(timestamp, now=None):
+    # The same wording as git's --date=relative (show_date_relative in date.c)
+    diff = int((time.time() if now is None else now) - timestamp)
+    if diff < 0:
+        return "in the future"
+    if diff < 90:
+        return plural(diff, "%d second ago", "%d seconds ago")
+    diff = (diff + 30) // 60
+    if diff < 90:
+        return plural(diff, "%d minute ago", "%d minutes ago")
+    diff = (diff + 30) // 60
+    if diff < 36:
+        return plural(diff, "%d hour ago", "%d hours ago")
+    diff = (diff + 12) // 24
+    if diff < 14:
+        return plural(diff, "%d day ago", "%d days ago")
+    if diff < 70:
+        return plural((diff + 3) // 7, "%d week ago", "%d weeks ago")
+    if diff < 365:
+        return plural((diff + 15) // 30, "%d month ago", "%d months ago")
+    if diff < 1825:
+        months = (diff * 12 * 2 + 365) // (365 * 2)
+        years = months // 12
+        months = months % 12
+        if months:
+            return plural(years, "%d year", "%d years") + ", " + plural(months, "%d month ago", "%d months ago")
+        return plural(years, "%d year ago", "%d years ago")
+    return plural((diff + 183) // 365, "%d year ago", "%d years ago")
+
+
+def record_line(info):
+    return '\0'.join((info.oid, info.author, info.email, str(info.time), info.subject)).encode('utf-8') + b'\n'
+
+
+def cache_directory():
+    try:
+        base = sublime.cache_path()
+    except AttributeError:
+        # Sublime Text 2
+        base = tempfile.gettempdir()
+    return os.path.join(base, 'Git', 'commits')
+
+
+class CommitIndex(object):
+    """Subjects, authors and dates of a repository's commits, kept on disk.
+
+    They never change for a given commit, so once git has told us there's
+    no need to ask again, even after a restart. The store is an append-only
+    file of records, plus lines noting which ref tips it's complete up to;
+    update() only asks git about commits reachable from new tips and not
+    from those. The oid index is an in-memory map to file offsets, built
+    when the file is first read, so a lookup is a seek per commit.
+
+    Past max_commits the oldest commits (by author date) are dropped: the
+    file is rewritten with the newest, down to nine tenths of the cap, so
+    it isn't rewritten again on every update. File access happens on the
+    repository's background lane, or under self.lock.
+    """
+    def __init__(self, root, path, max_commits):
+        self.root = root
+        self.path = path
+        self.max_commits = max_commits
+        self.lock = threading.Lock()
+        self.offsets = None
+        self.tips = []
+        self.updating = False
+
+    def load(self):
+        # Must hold the lock
+        if self.offsets is not None:
+            return
+        self.offsets = {}
+        self.tips = []
+        good = 0
+        try:
+            with io.open(self.path, 'rb') as f:
+                offset = 0
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # half-written by a crash; drop it
+                        break
+                    if line.startswith(b'tips\0'):
+                        self.tips = line[5:].decode('ascii').split()
+                    else:
+                        # the oid is 40 or 64 digits, with the hash
+                        end = line.find(b'\0')
+                        if end > 0:
+                            self.offsets[line[:end].decode('ascii', 'replace')] = offset
+                    offset += len(line)
+                    good = offset
+            if good != os.path.getsize(self.path):
+                with io.open(self.path, 'ab') as f:
+                    f.truncate(good)
+        except (IOError, OSError):
+            self.offsets = {}
+            self.tips = []
+
+    def __len__(self):
+        with self.lock:
+            self.load()
+            return len(self.offsets)
+
+    def lookup(self, oids):
+        """A {oid: CommitInfo} for whichever of oids are in the store."""
+        found = {}
+        with self.lock:
+            self.load()
+            wanted = [(self.offsets[oid], oid) for oid in oids if oid in self.offsets]
+            if not wanted:
+                return found
+            try:
+                with io.open(self.path, 'rb') as f:
+                    for offset, oid in sorted(wanted):
+                        f.seek(offset)
+                        info = CommitInfo.parse(f.readline().decode('utf-8', 'replace'))
+                        if info is not None:
+                            found[oid] = info
+            except (IOError, OSError):
+                pass
+        return found
+
+    def append(self, lines, tips=None):
+        """Stores the commits in lines, as git printed them with RECORD_FORMAT.
+
+        Returns what they held, and records tips, if given, as done with.
+        lines are taken to be newest first, as `git log` gives them, so past
+        max_commits the last are skipped; those are the oldest, which would
+        be dropped anyway.
+        """
+        records = [CommitInfo.parse(line) for line in lines]
+        records = [info for info in records if info is not None]
+        with self.lock:
+            self.load()
+            new = []
+            seen = set()
+            for info in records:
+                if info.oid not in self.offsets and info.oid not in seen:
+                    seen.add(info.oid)
+                    new.append(info)
+            del new[self.max_commits:]
+            if len(self.offsets) + len(new) > self.max_commits:
+                self.drop_oldest(min(self.max_commits - len(new), self.max_commits * 9 // 10))
+            try:
+                directory = os.path.dirname(self.path)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                with io.open(self.path, 'ab') as f:
+                    offset = f.seek(0, os.SEEK_END)
+                    for info in new:
+                        line = record_line(info)
+                        f.write(line)
+                        self.offsets[info.oid] = offset
+                        offset += len(line)
+                    if tips is not None:
+                        f.write(b'tips\0' + ' '.join(tips).encode('ascii') + b'\n')
+                        self.tips = list(tips)
+            except (IOError, OSError) as e:
+                print("Git: couldn't write commit index", self.path, e)
+        return records
+
+    def drop_oldest(self, keep):
+        # Must hold the lock. Rewrites the file with just the keep most
+        # recent commits (by author date) and the tips.
+        try:
+            with io.open(self.path, 'rb') as f:
+                records = []
+                for line in f:
+                    if not line.startswith(b'tips\0'):
+                        info = CommitInfo.parse(line.decode('utf-8', 'replace'))
+                        if info is not None:
+                            records.append(info)
+            records.sort(key=lambda info: info.time, reverse=True)
+            del records[max(0, keep):]
+            temporary = self.path + '.tmp'
+            offsets = {}
+            with io.open(temporary, 'wb') as f:
+                offset = 0
+                for info in records:
+                    line = record_line(info)
+                    f.write(line)
+                    offsets[info.oid] = offset
+                    offset += len(line)
+                if self.tips:
+                    f.write(b'tips\0' + ' '.join(self.tips).encode('ascii') + b'\n')
+            if os.name == 'nt':
+                # rename won't replace a file there
+                os.remove(self.path)
+            os.rename(temporary, self.path)
+            self.offsets = offsets
+        except (IOError, OSError) as e:
+            print("Git: couldn't trim commit index", self.path, e)
+            self.clear()
+
+    def clear(self):
+        # Must hold the lock
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self.offsets = {}
+        self.tips = []
+
+    def rebuild(self):
+        with self.lock:
+            self.clear()
+        self.update()
+
+    def update(self):
+        # Call from the main thread. Catches the store up with the repository's
+        # refs in the background.
+        if self.updating:
+            return
+        self.updating = True
+        self.git = git_binary()
+        CommandThread(
+            [self.git, 'for-each-ref', '--format=%(objectname)', 'refs/heads', 'refs/remotes', 'refs/tags'],
+            self.refs_done, working_dir=self.root, error_suppresses_output=True, background=True
+        ).start()
+
+    def refs_done(self, result):
+        tips = set(result.split())
+        head = head_oid(self.root)
+        if head:
+            tips.add(head)
+        tips = sorted(tips)
+
+        def job():
+            with self.lock:
+                self.load()
+                known = list(self.tips)
+            if not tips or tips == known:
+                self.updating = False
+                return
+            revs = tips + ['^' + tip for tip in known]
+            main_thread(self.run_log, revs, tips, known)
+        scheduler.submit(self.root, CommandScheduler.BACKGROUND, job, lane_size(CommandScheduler.BACKGROUND))
+
+    def run_log(self, revs, tips, known):
+        CommandThread(
+            [self.git, 'log', '--stdin', RECORD_FORMAT, '--max-count=%d' % self.max_commits],
+            self.log_done, working_dir=self.root, background=True,
+            stdin='\n'.join(revs) + '\n', tips=tips, known=known
+        ).start()
+
+    def log_done(self, result, tips, known, **kwargs):
+        # only on '\n': splitlines() also splits on characters a subject
+        # can hold
+        lines = [line for line in result.split('\n') if line]
+
+        def job():
+            # If git complained (most likely a tip we knew about has since
+            # been garbage collected), what it did print is kept, but the
+            # tips are forgotten and the update tried again without them;
+            # only once. If it stopped at --max-count, what's older than
+            # that is left out for good, as the cap would drop it anyway.
+            failed = any(CommitInfo.parse(line) is None for line in lines)
+            self.append(lines, [] if failed else tips)
+            self.updating = False
+            if failed and known:
+                main_thread(self.update)
+        scheduler.submit(self.root, CommandScheduler.BACKGROUND, job, lane_size(CommandScheduler.BACKGROUND))
+
+
+commit_indexes = {}
+
+
+def commit_index(root):
+    # Call from the main thread
+    s = sublime.load_settings("Git.sublime-settings")
+    max_commits = s.get('commit_index_max_commits', 500000)
+    index = commit_indexes.get(root)
+    if index is None:
+        name = hashlib.sha1(root.encode('utf-8')).hexdigest() + '.log'
+        index = commit_indexes[root] = CommitIndex(root, os.path.join(cache_directory(), name), max_commits)
+    index.max_commits = max_commits
+    return index
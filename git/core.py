@@ -3,7 +3,7 @@ from __future__ import absolute_import, unicode_literals, print_function, divisi
 import sublime
 import sublime_plugin
 
-from . import GitWindowCommand, GitTextCommand
+from . import GitWindowCommand, GitTextCommand, streams
 
 
 class GitCustomCommand(GitWindowCommand):
@@ -94,8 +94,25 @@ class GitGitkCommand(GitTextCommand):
 
 # called by GitWindowCommand
 class GitScratchOutputCommand(sublime_plugin.TextCommand):
-    def run(self, edit, output='', output_file=None, clear=False):
+    def run(self, edit, output='', output_file=None, clear=False, append=False):
         if clear:
             region = sublime.Region(0, self.view.size())
             self.view.erase(edit, region)
-        self.view.insert(edit, 0, output)
+        self.view.insert(edit, self.view.size() if append else 0, output)
+
+
+class GitReplaceLinesCommand(sublime_plugin.TextCommand):
+    # lines: [row, text] pairs; each row's text (without its newline) is
+    # swapped for the new text
+    def run(self, edit, lines=()):
+        for row, text in sorted(lines, reverse=True):
+            region = self.view.line(self.view.text_point(row, 0))
+            self.view.replace(edit, region, text)
+
+
+class GitStreamListener(sublime_plugin.EventListener):
+    def on_close(self, view):
+        # no point carrying on with a command nobody can see the output of
+        stream = streams.pop(view.id(), None)
+        if stream is not None:
+            stream.cancel()
@@ -29,7 +29,16 @@ class GitDiff (object):
         if ignore_whitespace:
             command.extend(('--ignore-all-space', '--ignore-blank-lines'))
         command.extend(('--', self.get_file_name()))
-        self.run_command(command, self.diff_done)
+        s = sublime.load_settings("Git.sublime-settings")
+        if s.get('diff_panel'):
+            self.run_command(command, self.diff_done)
+            return
+        self.stream_scratch(
+            command, lambda: self.panel("No output"), title="Git Diff",
+            syntax=s.get("diff_syntax", "Packages/Diff/Diff.tmLanguage"),
+            # We add meta-information from which we can infer the git_root after sublime restart
+            prefix=add_gitDiffRootToDiffOutput('', git_root(self.get_working_dir()))
+        )
 
     def diff_done(self, result):
         if not result.strip():
@@ -50,15 +59,11 @@ class GitDiffCommit (object):
         command = ['git', 'diff', '--cached', '--no-color']
         if ignore_whitespace:
             command.extend(('--ignore-all-space', '--ignore-blank-lines'))
-        self.run_command(command, self.diff_done)
-
-    def diff_done(self, result):
-        if not result.strip():
-            self.panel("No output")
-            return
         s = sublime.load_settings("Git.sublime-settings")
-        syntax = s.get("diff_syntax", "Packages/Diff/Diff.tmLanguage")
-        self.scratch(result, title="Git Diff", syntax=syntax)
+        self.stream_scratch(
+            command, lambda: self.panel("No output"), title="Git Diff",
+            syntax=s.get("diff_syntax", "Packages/Diff/Diff.tmLanguage")
+        )
 
 
 class GitDiffCommand(GitDiff, GitTextCommand):
@@ -5,6 +5,9 @@ from . import GitWindowCommand
 
 
 class GitFlowCommand(GitWindowCommand):
+    # finishing merges, and starting checks out a new branch
+    may_change_files = True
+
     def is_visible(self):
         s = sublime.load_settings("Git.sublime-settings")
         if s.get('flow'):
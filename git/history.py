@@ -1,31 +1,166 @@
 from __future__ import absolute_import, unicode_literals, print_function, division
 
 import functools
-import re
+import time
 
 import sublime
-from . import GitTextCommand, GitWindowCommand, plugin_file
+from . import GitTextCommand, GitWindowCommand, plugin_file, git_root, main_thread, view_fallback_encoding, _make_text_safeish
+from .blame import Blame, BlameParser, blames
+from .commits import RECORD_FORMAT, commit_index
+from .objects import blob_oid, head_oid, read_tree_index
+
+
+# How often, in seconds, a blame view is brought up to date as git's output
+# streams in
+BLAME_RENDER_INTERVAL = 0.25
 
 
 class GitBlameCommand(GitTextCommand):
+    # somewhat custom blame command:
+    # -w: ignore whitespace changes
+    # -M: retain blame when moving lines
+    # -C: retain blame when copying lines between files
+    blame_options = ('-w', '-M', '-C')
+    # -C has to look through other files, which on a big repository takes
+    # far longer than the rest; this much can be shown first
+    fast_options = ('-w',)
+
+    def blame_passes(self):
+        s = sublime.load_settings("Git.sublime-settings")
+        passes = s.get('blame_passes', 'progressive')
+        if passes == 'fast':
+            return [self.fast_options]
+        if passes == 'full':
+            return [self.blame_options]
+        return [self.fast_options, self.blame_options]
+
     def run(self, edit):
-        # somewhat custom blame command:
-        # -w: ignore whitespace changes
-        # -M: retain blame when moving lines
-        # -C: retain blame when copying lines between files
-        command = ['git', 'blame', '-w', '-M', '-C']
         line_ranges = [self.get_lines(selection) for selection in self.view.sel() if not selection.empty()]
 
+        # Blame reads the file on disk, so that's what results are kept
+        # against (along with HEAD); blaming it again unchanged costs nothing
+        s = sublime.load_settings("Git.sublime-settings")
+        if s.get('save_first') and self.view.is_dirty():
+            self.view.run_command('save')
+        try:
+            with open(self.view.file_name(), 'rb') as f:
+                data = f.read()
+        except (IOError, OSError) as e:
+            self.panel("Couldn't read %s: %s" % (self.get_file_name(), e))
+            return
+        root = git_root(self.get_working_dir())
+        text_lines = _make_text_safeish(data, view_fallback_encoding(self.view)).split('\n')
         if line_ranges:
-            for line_range in line_ranges:
-                command.extend(('-L', str(line_range[0]) + ',' + str(line_range[1])))
-            callback = self.blame_done
+            line_numbers = [n for start, end in line_ranges for n in range(start, end + 1)]
         else:
-            callback = functools.partial(self.blame_done,
-                                         focused_line=self.get_current_line())
+            line_numbers = list(range(1, len(text_lines) + (0 if data.endswith(b'\n') else 1)))
+        blamed = {
+            'key': (root, self.get_relative_file_path(), head_oid(root), blob_oid(data), tuple(line_ranges)),
+            'line_ranges': line_ranges,
+            'text_lines': text_lines,
+            'line_numbers': line_numbers,
+            'focused_line': 1 if line_ranges else self.get_current_line(),
+            # the view it's shown in, what's in it, and when that was
+            # last brought up to date while a pass streams in
+            'view': None,
+            'shown': None,
+            'blame': None,
+            'rendered': 0,
+        }
+
+        passes = self.blame_passes()
+        if blames.get(blamed['key'] + (passes[-1],)) is not None:
+            # no point in a rough answer when the best one is there already
+            passes = passes[-1:]
+        self.blame_pass(blamed, passes)
+
+    def blame_pass(self, blamed, passes):
+        options = passes[0]
+        blame = blames.get(blamed['key'] + (options,))
+        if blame is not None:
+            self.pass_done(blame, blamed, passes)
+            return
+        parser = BlameParser(Blame(blamed['key'][1]))
+        command = ['git', 'blame', '--incremental'] + list(options)
+        for line_range in blamed['line_ranges']:
+            command.extend(('-L', str(line_range[0]) + ',' + str(line_range[1])))
+        command.extend(('--', self.get_file_name()))
+        first = blamed['view'] is None
+        self.run_command(
+            command, self.blame_streamed, stream=functools.partial(self.blame_chunk, blamed, parser),
+            no_save=True, background=not first, show_status=first,
+            blamed=blamed, passes=passes, parser=parser)
+
+    def blame_chunk(self, blamed, parser, text):
+        parser.feed(text)
+        now = time.time()
+        if now - blamed['rendered'] >= BLAME_RENDER_INTERVAL and parser.blame.lines:
+            blamed['rendered'] = now
+            self.blame_progress(blamed, parser.blame)
+
+    def blame_progress(self, blamed, blame):
+        # Shows the blame so far; lines not yet reached keep what the last
+        # pass said about them, or wait until they're blamed
+        if blamed['blame'] is not None:
+            lines = dict(blamed['blame'].lines)
+            lines.update(blame.lines)
+            so_far = Blame(blame.path)
+            so_far.lines = lines
+            blame = so_far
+        self.show_blame(blamed, blame.render(blamed['text_lines'], blamed['line_numbers'], unblamed=True))
+
+    def blame_streamed(self, result, blamed, passes, parser):
+        parser.close()
+        blame = parser.blame
+        if result != 0 or not blame.lines:
+            # git's complaints are in errors; a blame it gave up on partway
+            # isn't worth keeping
+            if blamed['view'] is None:
+                self.panel('\n'.join(blame.errors) or "Nothing to blame")
+            elif blamed['blame'] is not None:
+                # put back what the last pass had
+                self.show_blame(blamed, blamed['blame'].render(blamed['text_lines'], blamed['line_numbers']))
+            return
+        blames.set(blamed['key'] + (passes[0],), blame)
+        self.pass_done(blame, blamed, passes)
 
-        command.append(self.get_file_name())
-        self.run_command(command, callback)
+    def pass_done(self, blame, blamed, passes):
+        text = blame.render(blamed['text_lines'], blamed['line_numbers'])
+        if not self.show_blame(blamed, text):
+            return
+        blamed['blame'] = blame
+        if len(passes) > 1:
+            self.blame_pass(blamed, passes[1:])
+
+    def show_blame(self, blamed, text):
+        # Returns False if the view has been closed
+        view = blamed['view']
+        if view is None:
+            blamed['view'] = self.blame_done(text, focused_line=blamed['focused_line'])
+        elif view.window() is None:
+            return False
+        elif text != blamed['shown']:
+            self.blame_refined(view, blamed['shown'], text)
+        blamed['shown'] = text
+        return True
+
+    def blame_refined(self, view, old, new):
+        # Rewrite just the lines whose attribution changed; unless that's
+        # most of them (the columns usually change width between passes),
+        # when one edit of the whole lot is far quicker
+        old_lines = old.split('\n')
+        new_lines = new.split('\n')
+        lines = []
+        if len(old_lines) == len(new_lines):
+            lines = [[row, line] for row, (was, line) in enumerate(zip(old_lines, new_lines)) if was != line]
+            if not lines:
+                return
+        view.set_read_only(False)
+        if not lines or len(lines) * 2 > len(new_lines):
+            view.run_command('git_scratch_output', {'output': new, 'clear': True})
+        else:
+            view.run_command('git_replace_lines', {'lines': lines})
+        view.set_read_only(True)
 
     def get_current_line(self):
         (current_line, column) = self.view.rowcol(self.view.sel()[0].a)
@@ -45,57 +180,143 @@ class GitBlameCommand(GitTextCommand):
         return begin_line + 1, end_line + 1
 
     def blame_done(self, result, focused_line=1):
-        self.scratch(
+        # returns the view, so later passes can refine what's in it
+        return self.scratch(
             result, title="Git Blame", focused_line=focused_line,
             syntax=plugin_file("syntax/Git Blame.tmLanguage")
         )
 
 
-class GitLog(object):
+class PagedLog(object):
+    # Shows `git log` in a quick panel a page at a time. The last entry loads
+    # the next page, which is fetched in the background while you're looking
+    # at this one, so however deep the history the panel opens straight away.
+    # git only lists the commits; what's shown for them comes from the
+    # repository's commit index, which has it on disk. self.results holds
+    # the rows shown so far, and self.oids the commits they're for.
+    log_generation = 0
+
+    def show_log(self, command, callback):
+        self.log_command = command
+        self.log_callback = callback
+        self.log_generation += 1
+        self.results = []
+        self.oids = []
+        self.next_page = None
+        self.more = False
+        self.waiting = True
+        self.commits = commit_index(git_root(self.get_working_dir()))
+        self.commits.update()
+        self.fetch_page(0, background=False)
+
+    def page_size(self):
+        s = sublime.load_settings("Git.sublime-settings")
+        return s.get('log_page_size', 300)
+
+    def fetch_page(self, skip, background):
+        size = self.page_size()
+        # ask for one extra to find out whether there's anything after this
+        # page, and before any '--', so they're not taken for paths
+        command = self.log_command[:2] + ['--format=%H', '--skip=%d' % skip, '--max-count=%d' % (size + 1)] + self.log_command[2:]
+        page = {'skip': skip, 'size': size, 'background': background, 'generation': self.log_generation}
+        self.run_command(command, self.page_listed, show_status=not background, background=background, page=page)
+
+    def stale(self, page):
+        return page['generation'] != self.log_generation or page['skip'] != len(self.results)
+
+    def page_listed(self, result, page):
+        if self.stale(page):
+            return
+        page['oids'] = [oid for oid in result.split() if len(oid) >= 40]
+        self.run_in_background(self.commits.lookup, self.page_found, page['oids'], page=page)
+
+    def page_found(self, found, page):
+        if self.stale(page):
+            return
+        # None if the lookup failed; git can still be asked
+        found = found or {}
+        missing = [oid for oid in page['oids'] if oid not in found]
+        if not missing:
+            self.page_done(found, page)
+            return
+        # not in the index (yet); ask git about just these
+        self.run_command(
+            ['git', 'log', '--no-walk', '--stdin', RECORD_FORMAT], self.missing_done,
+            show_status=False, background=page['background'],
+            stdin='\n'.join(missing) + '\n', found=found, page=page)
+
+    def missing_done(self, result, found, page, **kwargs):
+        self.run_in_background(self.commits.append, self.missing_added, result.split('\n'), found=found, page=page)
+
+    def missing_added(self, records, found, page):
+        for info in records or []:
+            found[info.oid] = info
+        self.page_done(found, page)
+
+    def page_done(self, found, page):
+        if self.stale(page):
+            return
+        size = page['size']
+        infos = [found[oid] for oid in page['oids'][:size] if oid in found]
+        rows = [[
+            "%s (%s)" % (info.subject, info.oid[:7]),
+            "%s <%s>" % (info.author, info.email),
+            "%s (%s)" % (info.date(), info.relative_date()),
+        ] for info in infos]
+        self.next_page = (rows, [info.oid for info in infos], len(page['oids']) > size)
+        if self.waiting:
+            self.show_page()
+
+    def show_page(self):
+        self.waiting = False
+        rows, oids, self.more = self.next_page
+        self.next_page = None
+        selected = max(len(self.results) - 1, 0) if not rows else len(self.results)
+        self.results.extend(rows)
+        self.oids.extend(oids)
+        if not self.results:
+            sublime.status_message("Nothing to show")
+            return
+        items = list(self.results)
+        if self.more:
+            items.append(["Load more...", "%d commits shown so far" % len(self.results), ""])
+            self.fetch_page(len(self.results), background=True)
+        self.quick_panel(items, self.page_picked, 0, selected)
+
+    def page_picked(self, picked):
+        if picked == len(self.results) and self.more:
+            if self.next_page is not None:
+                self.show_page()
+            else:
+                # still on its way
+                self.waiting = True
+            return
+        self.log_callback(picked)
+
+
+class GitLog(PagedLog):
     def run(self, edit=None):
         fn = self.get_file_name()
         return self.run_log(fn != '', '--', fn)
 
     def run_log(self, follow, *args):
-        # the ASCII bell (\a) is just a convenient character I'm pretty sure
-        # won't ever come up in the subject of the commit (and if it does then
-        # you positively deserve broken output...)
-        # 9000 is a pretty arbitrarily chosen limit; picked entirely because
-        # it's about the size of the largest repo I've tested this on... and
-        # there's a definite hiccup when it's loading that
-        command = [
-            'git', 'log', '--no-color', '--pretty=%s (%h)\a%an <%aE>\a%ad (%ar)',
-            '--date=local', '--max-count=9000',
-            '--follow' if follow else None
-        ]
+        command = ['git', 'log', '--no-color', '--follow' if follow else None]
         command.extend(args)
-        self.run_command(
-            command,
-            self.log_done)
-
-    def log_done(self, result):
-        self.results = [r.split('\a', 2) for r in result.strip().split('\n')]
-        self.quick_panel(self.results, self.log_panel_done)
+        self.show_log(command, self.log_panel_done)
 
     def log_panel_done(self, picked):
         if 0 > picked < len(self.results):
             return
-        item = self.results[picked]
-        # the commit hash is the last thing on the first line, in brackets
-        ref = item[0].split(' ')[-1].strip('()')
-        self.log_result(ref)
+        self.log_result(self.oids[picked])
 
     def log_result(self, ref):
         # I'm not certain I should have the file name here; it restricts the
         # details to just the current file. Depends on what the user expects...
         # which I'm not sure of.
-        self.run_command(
+        self.stream_scratch(
             ['git', 'log', '--no-color', '-p', '-1', ref, '--', self.get_file_name()],
-            self.details_done)
-
-    def details_done(self, result):
-        self.scratch(result, title="Git Commit Details",
-                     syntax=plugin_file("syntax/Git Commit View.tmLanguage"))
+            lambda: self.panel("No output"), title="Git Commit Details",
+            syntax=plugin_file("syntax/Git Commit View.tmLanguage"))
 
 
 class GitLogCommand(GitLog, GitTextCommand):
@@ -106,31 +327,23 @@ class GitLogAllCommand(GitLog, GitWindowCommand):
     pass
 
 
-class GitShow(object):
+class GitShow(PagedLog):
     def run(self, edit=None):
-        # GitLog Copy-Past
-        self.run_command(
-            ['git', 'log', '--no-color', '--pretty=%s (%h)\a%an <%aE>\a%ad (%ar)',
-             '--date=local', '--max-count=9000', '--', self.get_file_name()],
-            self.show_done)
-
-    def show_done(self, result):
-        # GitLog Copy-Past
-        self.results = [r.split('\a', 2) for r in result.strip().split('\n')]
-        self.quick_panel(self.results, self.panel_done)
+        self.show_log(['git', 'log', '--no-color', '--', self.get_file_name()], self.panel_done)
 
     def panel_done(self, picked):
         if 0 > picked < len(self.results):
             return
-        item = self.results[picked]
-        # the commit hash is the last thing on the first line, in brackets
-        ref = item[0].split(' ')[-1].strip('()')
-        self.run_command(
-            ['git', 'show', '%s:%s' % (ref, self.get_relative_file_path())],
+        ref = self.oids[picked]
+        self.read_blob(
+            ref, self.get_relative_file_path(),
             self.details_done,
-            ref=ref)
+            ref=ref[:7])
 
     def details_done(self, result, ref):
+        if result is None:
+            self.panel("%s doesn't exist in %s" % (self.get_relative_file_path(), ref))
+            return
         syntax = self.view.settings().get('syntax')
         self.scratch(result, title="%s:%s" % (ref, self.get_file_name()), syntax=syntax)
 
@@ -143,6 +356,12 @@ class GitShowAllCommand(GitShow, GitWindowCommand):
     pass
 
 
+class GitRebuildCommitIndexCommand(GitWindowCommand):
+    def run(self):
+        commit_index(git_root(self.get_working_dir())).rebuild()
+        sublime.status_message("Rebuilding the commit index")
+
+
 class GitShowCommitCommand(GitWindowCommand):
     def run(self, edit=None):
         self.window.show_input_panel("Commit to show:", "", self.input_done, None, None)
@@ -163,14 +382,12 @@ class GitShowCommitCommand(GitWindowCommand):
 class GitGraph(object):
     def run(self, edit=None):
         filename = self.get_file_name()
-        self.run_command(
+        self.stream_scratch(
             ['git', 'log', '--graph', '--pretty=%h -%d (%cr) (%ci) <%an> %s', '--abbrev-commit', '--no-color', '--decorate', '--date=relative', '--follow' if filename else None, '--', filename],
-            self.log_done
+            lambda: self.panel("No output"), title="Git Log Graph",
+            syntax=plugin_file("syntax/Git Graph.tmLanguage")
         )
 
-    def log_done(self, result):
-        self.scratch(result, title="Git Log Graph", syntax=plugin_file("syntax/Git Graph.tmLanguage"))
-
 
 class GitGraphCommand(GitGraph, GitTextCommand):
     pass
@@ -199,51 +416,58 @@ class GitOpenFileCommand(GitLog, GitWindowCommand):
 
     def log_result(self, result_hash):
         self.ref = result_hash
-        self.run_command(
-            ['git', 'ls-tree', '-r', '--full-tree', self.ref],
-            self.ls_done)
-
-    def ls_done(self, result):
-        # Last two items are the ref and the file name
-        # p.s. has to be a list of lists; tuples cause errors later
-        self.results = [[match.group(2), match.group(1)] for match in re.finditer(r"\S+\s(\S+)\t(.+)", result)]
+        # Trees are listed once and kept, so any other commit with the same
+        # tree opens straight away
+        read_tree_index(git_root(self.get_working_dir()), self.ref, functools.partial(main_thread, self.ls_done))
 
-        self.quick_panel(self.results, self.ls_panel_done)
+    def ls_done(self, index):
+        if index is None:
+            self.panel("Couldn't list the files in %s" % self.ref)
+            return
+        self.tree_index = index
+        self.quick_panel(index.paths(), self.ls_panel_done)
 
     def ls_panel_done(self, picked):
-        if 0 > picked < len(self.results):
+        if 0 > picked < len(self.tree_index):
             return
-        item = self.results[picked]
 
-        self.filename = item[0]
-        self.fileRef = item[1]
+        self.filename = self.tree_index.path(picked)
+        self.fileRef = self.tree_index.oid(picked)
 
-        self.run_command(
-            ['git', 'show', self.fileRef],
-            self.show_done)
+        self.read_object(self.fileRef, self.show_done)
 
     def show_done(self, result):
+        if result is None:
+            self.panel("Object %s not found" % self.fileRef)
+            return
         self.scratch(result, title="%s:%s" % (self.fileRef, self.filename))
 
 
 class GitDocumentCommand(GitBlameCommand):
-    def blame_done(self, result, focused_line=1):
-        shas = set((sha for sha in re.findall(r'^[0-9a-f]+', result, re.MULTILINE) if not re.match(r'^0+$', sha)))
-        command = ['git', 'show', '-s', '-z', '--no-color', '--date=iso']
-        command.extend(shas)
-
-        self.run_command(command, self.show_done)
+    def blame_passes(self):
+        # there's nothing to refine afterwards, so go straight to the best answer
+        return [self.blame_options]
+
+    def blame_progress(self, blamed, blame):
+        # nothing to show until the messages are in
+        pass
+
+    def pass_done(self, blame, blamed, passes):
+        # The blame already says who made each commit and when; only the
+        # messages need reading
+        commits = set(commit for commit, orig_line, filename in blame.lines.values() if not commit.uncommitted)
+        commits = sorted(commits, key=lambda commit: commit.author_time, reverse=True)
+        self.read_commit_messages([commit.sha for commit in commits], self.messages_done, commits=commits)
+
+    def messages_done(self, messages, commits):
+        documentation = []
+        for commit in commits:
+            message = messages.get(commit.sha, commit.summary).rstrip('\n')
+            documentation.append("commit %s\nAuthor: %s %s\nDate:   %s\n\n%s" % (
+                commit.sha, commit.author, commit.author_mail, commit.date(),
+                '\n'.join(('    ' + line).rstrip() for line in message.split('\n'))))
 
-    def show_done(self, result):
-        commits = []
-        for commit in result.split('\0'):
-            match = re.search(r'^Date:\s+(.+)$', commit, re.MULTILINE)
-            if match:
-                commits.append((match.group(1), commit))
-        commits.sort(reverse=True)
-        commits = [commit for d, commit in commits]
-
-        self.scratch('\n\n'.join(commits), title="Git Commit Documentation",
+        self.scratch('\n\n'.join(documentation), title="Git Commit Documentation",
                      syntax=plugin_file("syntax/Git Commit View.tmLanguage"))
 
 
@@ -273,7 +497,4 @@ class GitGotoCommit(GitTextCommand):
 
     def is_enabled(self):
         selection = self.view.sel()[0]
-        return (
-            self.view.match_selector(selection.a, "text.git-blame") or
-            self.view.match_selector(selection.a, "text.git-graph")
-        )
+        return any(self.view.match_selector(selection.a, scope) for scope in ("text.git-blame", "text.git-graph"))
@@ -1,11 +1,12 @@
 from __future__ import absolute_import, unicode_literals, print_function, division
 
-import functools
 import os
+import subprocess
+import time
 
 import sublime
 import sublime_plugin
-from . import GitTextCommand
+from . import GitTextCommand, git_binary, git_root, git_dir, git_common_dir, file_stamp, popen_options, main_thread, scheduler, CommandScheduler, lane_size
 
 
 class GitIgnoreEventListener(sublime_plugin.EventListener):
@@ -23,6 +24,111 @@ class GitIgnoreEventListener(sublime_plugin.EventListener):
             view.run_command("git_update_ignore")
 
 
+# What a scan of a directory found, by directory: (time, stamps, files,
+# folders, submodules). The stamps are of everything that decides what's
+# ignored in it - every .gitignore and the directory it's in, info/exclude,
+# the global excludes file, the config files naming it, .gitmodules, the
+# folders found to be ignored and the directories the ignored files are in -
+# so while none of them have changed the scan stands and git isn't asked
+# again. An ignored file can still turn up in some other directory, which
+# nothing here would notice; so a scan is only trusted for IGNORE_SCAN_TTL
+# seconds.
+ignore_scans = {}
+IGNORE_SCAN_TTL = 60
+
+# Windows with a sync on the way, so that switching views doesn't pile more up
+ignore_syncs = set()
+
+
+def ignore_stamps(sources):
+    return tuple((path, file_stamp(path)) for path in sources)
+
+
+def git_output(git, args, cwd):
+    # stdout of a git command as text, or None if it failed
+    with open(os.devnull, 'wb') as devnull:
+        proc = subprocess.Popen(
+            [git] + args, stdin=devnull, stdout=subprocess.PIPE, stderr=devnull,
+            cwd=cwd, **popen_options(background=True))
+    output = proc.communicate()[0]
+    if proc.returncode:
+        return None
+    return output.decode('utf-8', 'replace')
+
+
+def scan_ignored(git, directory, root):
+    """(files, folders, submodules) ignored in directory, as relative paths.
+
+    root is the repository directory is in. The answer is kept in
+    ignore_scans; None if git couldn't say.
+    """
+    now = time.time()
+    cached = ignore_scans.get(directory)
+    if cached is not None and now - cached[0] < IGNORE_SCAN_TTL and cached[1] == ignore_stamps(source for source, stamp in cached[1]):
+        return cached[2:]
+
+    gitdir = git_common_dir(git_dir(root))
+    home = os.path.expanduser('~')
+    sources = [
+        os.path.join(gitdir, 'info', 'exclude'),
+        os.path.join(gitdir, 'config'),
+        os.path.join(home, '.gitconfig'),
+        os.path.join(root, '.gitmodules'),
+    ]
+    excludes_file = git_output(git, ['config', '--path', '--get', 'core.excludesFile'], directory)
+    if excludes_file and excludes_file.strip():
+        sources.append(os.path.expanduser(excludes_file.strip()))
+    else:
+        config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.join(home, '.config')
+        sources.append(os.path.join(config_home, 'git', 'ignore'))
+        sources.append(os.path.join(config_home, 'git', 'config'))
+    # The .gitignore files themselves, and the directories they're in, which
+    # also catches new files turning up next to them
+    gitignores = git_output(git, ['ls-files', '-z', '--cached', '--others', '--exclude-standard', '--', '.gitignore', '*/.gitignore'], root)
+    if gitignores is None:
+        return None
+    for path in gitignores.split('\0'):
+        if path:
+            path = os.path.join(root, path)
+            sources.append(path)
+            sources.append(os.path.dirname(path))
+    sources = sorted(set(sources))
+    # taken before asking, so anything changing while git looks means
+    # looking again next time
+    stamps = ignore_stamps(sources)
+
+    ignored = git_output(git, ['ls-files', '-z', '--others', '--ignored', '--exclude-standard', '--directory'], directory)
+    if ignored is None:
+        return None
+    files = set()
+    folders = set()
+    for path in ignored.split('\0'):
+        if path.endswith('/'):
+            folders.add(path.rstrip('/'))
+        elif path:
+            files.add(path)
+    # A folder is listed when everything in it is ignored, which stops being
+    # true if something else turns up in it; and another ignored file most
+    # likely turns up next to the ones there are
+    listed = set(os.path.join(directory, folder) for folder in folders)
+    listed.update(os.path.dirname(os.path.join(directory, path)) for path in files)
+    stamps += ignore_stamps(sorted(listed.difference(sources)))
+
+    submodules = []
+    modules = git_output(git, ['config', '-z', '--file', '.gitmodules', '--get-regexp', r'^submodule\..*\.path$'], root) or ''
+    for entry in modules.split('\0'):
+        key, _, path = entry.partition('\n')
+        if not path or not os.path.exists(os.path.join(root, path, '.git')):
+            # not checked out
+            continue
+        path = os.path.relpath(os.path.join(root, path), directory)
+        if not path.startswith('..'):
+            submodules.append(path)
+
+    ignore_scans[directory] = (now, stamps, files, folders, submodules)
+    return files, folders, submodules
+
+
 class GitUpdateIgnoreCommand(GitTextCommand):
     def path(self, folderpath):
         project_file_name = self.view.window().project_file_name()
@@ -31,74 +137,74 @@ class GitUpdateIgnoreCommand(GitTextCommand):
         return folderpath
 
     def run(self, edit):
+        window = self.view.window()
+        self.window_id = window.id()
+        if self.window_id in ignore_syncs:
+            return
+        ignore_syncs.add(self.window_id)
         self.count = 0
+        self.failed = False
         self.excludes = {}
+        self.git = git_binary()
+        self.lane_size = lane_size(CommandScheduler.BACKGROUND)
 
-        data = self.view.window().project_data()
+        # Every folder and submodule is scanned on its own repository's
+        # background lane, so different repositories are looked at at once
+        data = window.project_data()
         for index, folder in enumerate(data['folders']):
-            self.count += 2
             self.excludes[index] = {
                 'files': set(),
                 'folders': set(),
             }
-
-            path = self.path(folder['path'])
-            callback = functools.partial(self.ignored_files_found, folder_index=index)
-            self.run_command(
-                ['git', 'status', '--ignored', '--porcelain'],
-                callback=callback,
-                working_dir=path,
-                error_suppresses_output=True,
-                show_status=False
-            )
-            self.run_command(
-                ['git', 'submodule', 'foreach', 'git status --ignored --porcelain'],
-                callback=callback,
-                working_dir=path,
-                error_suppresses_output=True,
-                show_status=False
-            )
-
-    def ignored_files_found(self, result, folder_index):
+            self.scan(index, self.path(folder['path']), '')
+        if not self.count:
+            ignore_syncs.discard(self.window_id)
+
+    def scan(self, folder_index, directory, prefix):
+        root = git_root(directory)
+        if not root:
+            if not prefix:
+                # not in a repository; leave its patterns alone
+                self.excludes[folder_index] = None
+            return
+        self.count += 1
+
+        def job():
+            # whatever happens, this window's sync has to hear back, or it
+            # will never run again
+            result = None
+            try:
+                result = scan_ignored(self.git, directory, root)
+            except (IOError, OSError) as e:
+                print("Git: couldn't scan for ignored files", directory, e)
+            finally:
+                main_thread(self.ignored_files_found, result, folder_index, directory, prefix)
+        scheduler.submit(root, CommandScheduler.BACKGROUND, job, self.lane_size)
+
+    def ignored_files_found(self, result, folder_index, directory, prefix):
         self.count -= 1
 
-        self.process_ignored_files(result, folder_index)
+        if result is None:
+            self.failed = True
+        else:
+            files, folders, submodules = result
+            self.excludes[folder_index]['files'].update(os.path.join(prefix, path) for path in files)
+            self.excludes[folder_index]['folders'].update(os.path.join(prefix, path) for path in folders)
+            for path in submodules:
+                self.scan(folder_index, os.path.join(directory, path), os.path.join(prefix, path))
 
         if self.count == 0:
-            self.all_ignored_files_found()
-
-    def process_ignored_files(self, result, folder_index):
-        data = self.view.window().project_data()
-        folder = data['folders'][folder_index]
-
-        if not folder:
-            return
-        if not result or result.isspace():
-            return
-
-        root = self.path(folder['path'])
-        exclude_folders = self.excludes[folder_index]['folders']
-        exclude_files = self.excludes[folder_index]['files']
-
-        subroot = ''
-        for line in result.strip().split('\n'):
-            if line.startswith('Entering'):
-                subroot = line.replace('Entering ', '').replace('\'', '')
-            if not line.startswith('!!'):
-                continue
-            path = os.path.join(subroot, line.replace('!! ', ''))
-
-            if os.path.isdir(os.path.join(root, path)):
-                exclude_folders.add(path.rstrip('\\/'))
-            else:
-                exclude_files.add(path)
-
-        return exclude_files, exclude_folders
+            ignore_syncs.discard(self.window_id)
+            # rather than clear a folder's patterns because git fell over
+            if not self.failed:
+                self.all_ignored_files_found()
 
     def all_ignored_files_found(self):
         data = self.view.window().project_data()
         changed = False
         for index, folder in enumerate(data['folders']):
+            if self.excludes[index] is None:
+                continue
             exclude_folders = self.excludes[index]['folders']
             exclude_files = self.excludes[index]['files']
 
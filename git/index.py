@@ -9,8 +9,8 @@ from .status import GitStatusCommand
 
 
 class GitUpdateIndexAssumeUnchangedCommand(GitStatusCommand):
-    def status_filter(self, item):
-        return super(GitUpdateIndexAssumeUnchangedCommand, self).status_filter(item) and not item[1].isspace()
+    def status_filter(self, entry):
+        return super(GitUpdateIndexAssumeUnchangedCommand, self).status_filter(entry) and entry.worktree != ' '
 
     def show_status_list(self):
         self.results = [] + [[a, ''] for a in self.results]
@@ -20,7 +20,6 @@ class GitUpdateIndexAssumeUnchangedCommand(GitStatusCommand):
         working_dir = git_root(self.get_working_dir())
 
         command = ['git']
-        picked_file = picked_file.strip('"')
         if os.path.exists(working_dir + "/" + picked_file):
             command += ['update-index', '--assume-unchanged']
         command += ['--', picked_file]
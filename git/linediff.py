@@ -0,0 +1,665 @@
+"""Line diffs without leaving Python.
+
+Live annotations used to write the buffer and the HEAD blob out to temp files
+and run `git diff -u` over them on every edit. This does the same job on the
+two texts directly. It follows git's own xdiff closely (the same Myers split
+with its cost heuristics, the same discarding of lines that can't match, and
+the same sliding of change groups with the indent heuristic) so that the
+lines it marks are the ones `git diff` would have marked.
+
+split_lines() breaks a text into lines the way git sees them, opcodes() finds
+the edits between two lists of lines, and classify() turns those into the
+x/+/- annotations GitAnnotateCommand used to get by parsing git's output.
+"""
+
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+# Tuning constants, as in xdiff
+MAX_EQLIMIT = 1024
+SIMSCAN_WINDOW = 100
+KPDIS_RUN = 4
+MAX_COST_MIN = 256
+HEUR_MIN_COST = 256
+SNAKE_CNT = 20
+K_HEUR = 4
+
+MAX_INDENT = 200
+MAX_BLANKS = 20
+START_OF_FILE_PENALTY = 1
+END_OF_FILE_PENALTY = 21
+TOTAL_BLANK_WEIGHT = -30
+POST_BLANK_WEIGHT = 6
+RELATIVE_INDENT_PENALTY = -4
+RELATIVE_INDENT_WITH_BLANK_PENALTY = 10
+RELATIVE_OUTDENT_PENALTY = 24
+RELATIVE_OUTDENT_WITH_BLANK_PENALTY = 17
+RELATIVE_DEDENT_PENALTY = 23
+RELATIVE_DEDENT_WITH_BLANK_PENALTY = 17
+INDENT_WEIGHT = 60
+INDENT_HEURISTIC_MAX_SLIDING = 100
+
+# how many lines past an edit update_opcodes re-diffs, so that the indent
+# heuristic and the diff itself see roughly what a full diff would
+UPDATE_MARGIN = 20
+
+LINE_MAX = float('inf')
+
+
+def split_lines(text):
+    # Lines keep their "\n" so that a last line without one differs from the
+    # same line with one, which is how git sees it too.
+    lines = text.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def bogosqrt(n):
+    i = 1
+    while n > 0:
+        n >>= 2
+        i <<= 1
+    return i
+
+
+class DiffFile(object):
+    # One side of a diff: its lines as ints (equal lines, equal ints) and a
+    # changed flag per line. rchg has a zero at each end so that looking one
+    # past either edge needs no bounds checks; rchg[i + 1] is line i.
+    def __init__(self, ha):
+        self.ha = ha
+        self.nrec = len(ha)
+        self.rchg = [0] * (self.nrec + 2)
+
+    def changed(self, i):
+        return self.rchg[i + 1]
+
+    def set_changed(self, i, value=1):
+        self.rchg[i + 1] = value
+
+
+def intern_lines(a, b):
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in a]
+    b = [ids.setdefault(line, len(ids)) for line in b]
+    return a, b
+
+
+def clean_mmatch(dis, i, s, e):
+    # A line that matches too many others is only worth keeping if it isn't
+    # sitting in the middle of a run of lines that have no match at all
+    if i - s > SIMSCAN_WINDOW:
+        s = i - SIMSCAN_WINDOW
+    if e - i > SIMSCAN_WINDOW:
+        e = i + SIMSCAN_WINDOW
+    rdis0 = 0
+    rpdis0 = 1
+    r = 1
+    while i - r >= s:
+        if not dis[i - r]:
+            rdis0 += 1
+        elif dis[i - r] == 2:
+            rpdis0 += 1
+        else:
+            break
+        r += 1
+    if rdis0 == 0:
+        return False
+    rdis1 = 0
+    rpdis1 = 1
+    r = 1
+    while i + r <= e:
+        if not dis[i + r]:
+            rdis1 += 1
+        elif dis[i + r] == 2:
+            rpdis1 += 1
+        else:
+            break
+        r += 1
+    if rdis1 == 0:
+        return False
+    rdis1 += rdis0
+    rpdis1 += rpdis0
+    return rpdis1 * KPDIS_RUN < rpdis1 + rdis1
+
+
+def optimize(xdf1, xdf2):
+    # Trims the common ends, then drops lines that can't usefully match from
+    # the search (marking them changed), returning for each side the lines
+    # left to diff and their indexes in the full file.
+    limit = min(xdf1.nrec, xdf2.nrec)
+    start = 0
+    while start < limit and xdf1.ha[start] == xdf2.ha[start]:
+        start += 1
+    tail = 0
+    while tail < limit - start and xdf1.ha[xdf1.nrec - 1 - tail] == xdf2.ha[xdf2.nrec - 1 - tail]:
+        tail += 1
+    end1 = xdf1.nrec - tail - 1
+    end2 = xdf2.nrec - tail - 1
+
+    counts1 = {}
+    for ha in xdf1.ha:
+        counts1[ha] = counts1.get(ha, 0) + 1
+    counts2 = {}
+    for ha in xdf2.ha:
+        counts2[ha] = counts2.get(ha, 0) + 1
+
+    result = []
+    for xdf, end, other_counts in ((xdf1, end1, counts2), (xdf2, end2, counts1)):
+        mlim = min(bogosqrt(xdf.nrec), MAX_EQLIMIT)
+        dis = {}
+        for i in range(start, end + 1):
+            nm = other_counts.get(xdf.ha[i], 0)
+            dis[i] = 0 if nm == 0 else 2 if nm >= mlim else 1
+        index = []
+        for i in range(start, end + 1):
+            if dis[i] == 1 or (dis[i] == 2 and not clean_mmatch(dis, i, start, end)):
+                index.append(i)
+            else:
+                xdf.set_changed(i)
+        result.append(index)
+    return result
+
+
+def split(ha1, off1, lim1, ha2, off2, lim2, need_min, mxcost):
+    # Finds where to divide the box [off1, lim1) x [off2, lim2): the middle
+    # of an optimal path, or once that's getting too expensive, a good
+    # enough one. Returns (i1, i2, min_lo, min_hi).
+    dmin = off1 - lim2
+    dmax = lim1 - off2
+    fmid = off1 - off2
+    bmid = lim1 - lim2
+    odd = (fmid - bmid) & 1
+    fmin = fmax = fmid
+    bmin = bmax = bmid
+    kvdf = {fmid: off1}
+    kvdb = {bmid: lim1}
+
+    ec = 0
+    while True:
+        ec += 1
+        got_snake = False
+
+        if fmin > dmin:
+            fmin -= 1
+            kvdf[fmin - 1] = -1
+        else:
+            fmin += 1
+        if fmax < dmax:
+            fmax += 1
+            kvdf[fmax + 1] = -1
+        else:
+            fmax -= 1
+
+        for d in range(fmax, fmin - 1, -2):
+            if kvdf[d - 1] >= kvdf[d + 1]:
+                i1 = kvdf[d - 1] + 1
+            else:
+                i1 = kvdf[d + 1]
+            prev1 = i1
+            i2 = i1 - d
+            while i1 < lim1 and i2 < lim2 and ha1[i1] == ha2[i2]:
+                i1 += 1
+                i2 += 1
+            if i1 - prev1 > SNAKE_CNT:
+                got_snake = True
+            kvdf[d] = i1
+            if odd and bmin <= d <= bmax and kvdb[d] <= i1:
+                return i1, i2, True, True
+
+        if bmin > dmin:
+            bmin -= 1
+            kvdb[bmin - 1] = LINE_MAX
+        else:
+            bmin += 1
+        if bmax < dmax:
+            bmax += 1
+            kvdb[bmax + 1] = LINE_MAX
+        else:
+            bmax -= 1
+
+        for d in range(bmax, bmin - 1, -2):
+            if kvdb[d - 1] < kvdb[d + 1]:
+                i1 = kvdb[d - 1]
+            else:
+                i1 = kvdb[d + 1] - 1
+            prev1 = i1
+            i2 = i1 - d
+            while i1 > off1 and i2 > off2 and ha1[i1 - 1] == ha2[i2 - 1]:
+                i1 -= 1
+                i2 -= 1
+            if prev1 - i1 > SNAKE_CNT:
+                got_snake = True
+            kvdb[d] = i1
+            if not odd and fmin <= d <= fmax and i1 <= kvdf[d]:
+                return i1, i2, True, True
+
+        if need_min:
+            continue
+
+        if got_snake and ec > HEUR_MIN_COST:
+            best = 0
+            for d in range(fmax, fmin - 1, -2):
+                dd = d - fmid if d > fmid else fmid - d
+                i1 = kvdf[d]
+                i2 = i1 - d
+                v = (i1 - off1) + (i2 - off2) - dd
+                inside = off1 + SNAKE_CNT <= i1 < lim1 and off2 + SNAKE_CNT <= i2 < lim2
+                if v > K_HEUR * ec and v > best and inside:
+                    k = 1
+                    while ha1[i1 - k] == ha2[i2 - k]:
+                        if k == SNAKE_CNT:
+                            best = v
+                            spl = i1, i2
+                            break
+                        k += 1
+            if best > 0:
+                return spl[0], spl[1], True, False
+
+            best = 0
+            for d in range(bmax, bmin - 1, -2):
+                dd = d - bmid if d > bmid else bmid - d
+                i1 = kvdb[d]
+                i2 = i1 - d
+                v = (lim1 - i1) + (lim2 - i2) - dd
+                inside = off1 < i1 <= lim1 - SNAKE_CNT and off2 < i2 <= lim2 - SNAKE_CNT
+                if v > K_HEUR * ec and v > best and inside:
+                    k = 0
+                    while ha1[i1 + k] == ha2[i2 + k]:
+                        if k == SNAKE_CNT - 1:
+                            best = v
+                            spl = i1, i2
+                            break
+                        k += 1
+            if best > 0:
+                return spl[0], spl[1], False, True
+
+        if ec >= mxcost:
+            # Enough is enough: take whichever path got furthest
+            fbest = fbest1 = -1
+            for d in range(fmax, fmin - 1, -2):
+                i1 = min(kvdf[d], lim1)
+                i2 = i1 - d
+                if lim2 < i2:
+                    i1 = lim2 + d
+                    i2 = lim2
+                if fbest < i1 + i2:
+                    fbest = i1 + i2
+                    fbest1 = i1
+            bbest = bbest1 = LINE_MAX
+            for d in range(bmax, bmin - 1, -2):
+                i1 = max(off1, kvdb[d])
+                i2 = i1 - d
+                if i2 < off2:
+                    i1 = off2 + d
+                    i2 = off2
+                if i1 + i2 < bbest:
+                    bbest = i1 + i2
+                    bbest1 = i1
+            if (lim1 + lim2) - bbest < fbest - (off1 + off2):
+                return fbest1, fbest - fbest1, True, False
+            return bbest1, bbest - bbest1, False, True
+
+
+def compare(xdf1, index1, xdf2, index2):
+    ha1 = [xdf1.ha[i] for i in index1]
+    ha2 = [xdf2.ha[i] for i in index2]
+    mxcost = max(bogosqrt(len(ha1) + len(ha2) + 3), MAX_COST_MIN)
+    stack = [(0, len(ha1), 0, len(ha2), False)]
+    while stack:
+        off1, lim1, off2, lim2, need_min = stack.pop()
+        while off1 < lim1 and off2 < lim2 and ha1[off1] == ha2[off2]:
+            off1 += 1
+            off2 += 1
+        while off1 < lim1 and off2 < lim2 and ha1[lim1 - 1] == ha2[lim2 - 1]:
+            lim1 -= 1
+            lim2 -= 1
+        if off1 == lim1:
+            for i in range(off2, lim2):
+                xdf2.set_changed(index2[i])
+        elif off2 == lim2:
+            for i in range(off1, lim1):
+                xdf1.set_changed(index1[i])
+        else:
+            i1, i2, min_lo, min_hi = split(ha1, off1, lim1, ha2, off2, lim2, need_min, mxcost)
+            stack.append((i1, lim1, i2, lim2, min_hi))
+            stack.append((off1, i1, off2, i2, min_lo))
+
+
+# Change groups, as in xdiff: [start, end) runs of changed lines, which may be
+# empty. Each function returns False where xdiff's would return -1.
+
+def group_init(xdf):
+    end = 0
+    while xdf.changed(end):
+        end += 1
+    return [0, end]
+
+
+def group_next(xdf, g):
+    if g[1] == xdf.nrec:
+        return False
+    g[0] = g[1] + 1
+    g[1] = g[0]
+    while xdf.changed(g[1]):
+        g[1] += 1
+    return True
+
+
+def group_previous(xdf, g):
+    if g[0] == 0:
+        return False
+    g[1] = g[0] - 1
+    g[0] = g[1]
+    while xdf.changed(g[0] - 1):
+        g[0] -= 1
+    return True
+
+
+def group_slide_down(xdf, g):
+    if g[1] < xdf.nrec and xdf.ha[g[0]] == xdf.ha[g[1]]:
+        xdf.set_changed(g[0], 0)
+        xdf.set_changed(g[1])
+        g[0] += 1
+        g[1] += 1
+        while xdf.changed(g[1]):
+            g[1] += 1
+        return True
+    return False
+
+
+def group_slide_up(xdf, g):
+    if g[0] > 0 and xdf.ha[g[0] - 1] == xdf.ha[g[1] - 1]:
+        g[0] -= 1
+        g[1] -= 1
+        xdf.set_changed(g[0])
+        xdf.set_changed(g[1], 0)
+        while xdf.changed(g[0] - 1):
+            g[0] -= 1
+        return True
+    return False
+
+
+def get_indent(line):
+    indent = 0
+    for c in line:
+        if c not in ' \t\n\v\f\r':
+            return indent
+        elif c == ' ':
+            indent += 1
+        elif c == '\t':
+            indent += 8 - indent % 8
+        if indent >= MAX_INDENT:
+            return MAX_INDENT
+    # only whitespace
+    return -1
+
+
+def split_score(lines, split, score):
+    # measure the split...
+    if split >= len(lines):
+        end_of_file = True
+        indent = -1
+    else:
+        end_of_file = False
+        indent = get_indent(lines[split])
+
+    pre_blank = 0
+    pre_indent = -1
+    for i in range(split - 1, -1, -1):
+        pre_indent = get_indent(lines[i])
+        if pre_indent != -1:
+            break
+        pre_blank += 1
+        if pre_blank == MAX_BLANKS:
+            pre_indent = 0
+            break
+
+    post_blank = 0
+    post_indent = -1
+    for i in range(split + 1, len(lines)):
+        post_indent = get_indent(lines[i])
+        if post_indent != -1:
+            break
+        post_blank += 1
+        if post_blank == MAX_BLANKS:
+            post_indent = 0
+            break
+
+    # ...and score it
+    effective_indent, penalty = score
+    if pre_indent == -1 and pre_blank == 0:
+        penalty += START_OF_FILE_PENALTY
+    if end_of_file:
+        penalty += END_OF_FILE_PENALTY
+
+    post_blank = 1 + post_blank if indent == -1 else 0
+    total_blank = pre_blank + post_blank
+    penalty += TOTAL_BLANK_WEIGHT * total_blank
+    penalty += POST_BLANK_WEIGHT * post_blank
+
+    if indent == -1:
+        indent = post_indent
+    any_blanks = total_blank != 0
+    effective_indent += indent
+
+    if indent == -1 or pre_indent == -1 or indent == pre_indent:
+        pass
+    elif indent > pre_indent:
+        penalty += RELATIVE_INDENT_WITH_BLANK_PENALTY if any_blanks else RELATIVE_INDENT_PENALTY
+    elif post_indent != -1 and post_indent > indent:
+        penalty += RELATIVE_OUTDENT_WITH_BLANK_PENALTY if any_blanks else RELATIVE_OUTDENT_PENALTY
+    else:
+        penalty += RELATIVE_DEDENT_WITH_BLANK_PENALTY if any_blanks else RELATIVE_DEDENT_PENALTY
+    return effective_indent, penalty
+
+
+def score_cmp(s1, s2):
+    cmp_indents = (s1[0] > s2[0]) - (s1[0] < s2[0])
+    return INDENT_WEIGHT * cmp_indents + (s1[1] - s2[1])
+
+
+def change_compact(xdf, xdfo, lines):
+    # Slides each group of changes as far as it will go, merging it with any
+    # it runs into, then settles it where it lines up with a change on the
+    # other side or, failing that, where the indent heuristic likes it best.
+    g = group_init(xdf)
+    go = group_init(xdfo)
+    while True:
+        if g[1] != g[0]:
+            while True:
+                groupsize = g[1] - g[0]
+                end_matching_other = -1
+                while group_slide_up(xdf, g):
+                    group_previous(xdfo, go)
+                earliest_end = g[1]
+                if go[1] > go[0]:
+                    end_matching_other = g[1]
+                while group_slide_down(xdf, g):
+                    group_next(xdfo, go)
+                    if go[1] > go[0]:
+                        end_matching_other = g[1]
+                if groupsize == g[1] - g[0]:
+                    break
+
+            if g[1] == earliest_end:
+                pass
+            elif end_matching_other != -1:
+                while go[1] == go[0]:
+                    group_slide_up(xdf, g)
+                    group_previous(xdfo, go)
+            else:
+                shift = max(earliest_end, g[1] - groupsize - 1, g[1] - INDENT_HEURISTIC_MAX_SLIDING)
+                best_shift = -1
+                best_score = None
+                while shift <= g[1]:
+                    score = split_score(lines, shift, (0, 0))
+                    score = split_score(lines, shift - groupsize, score)
+                    if best_shift == -1 or score_cmp(score, best_score) <= 0:
+                        best_score = score
+                        best_shift = shift
+                    shift += 1
+                while g[1] > best_shift:
+                    group_slide_up(xdf, g)
+                    group_previous(xdfo, go)
+
+        if not group_next(xdf, g):
+            break
+        group_next(xdfo, go)
+
+
+def opcodes(a, b):
+    """Like difflib's get_opcodes: a list of (tag, i1, i2, j1, j2) covering both lists."""
+    ha1, ha2 = intern_lines(a, b)
+    xdf1 = DiffFile(ha1)
+    xdf2 = DiffFile(ha2)
+    index1, index2 = optimize(xdf1, xdf2)
+    compare(xdf1, index1, xdf2, index2)
+    change_compact(xdf1, xdf2, a)
+    change_compact(xdf2, xdf1, b)
+
+    codes = []
+    i = j = 0
+    while i < xdf1.nrec or j < xdf2.nrec:
+        i1, j1 = i, j
+        if xdf1.changed(i) or xdf2.changed(j):
+            while xdf1.changed(i):
+                i += 1
+            while xdf2.changed(j):
+                j += 1
+            tag = 'replace' if i > i1 and j > j1 else 'delete' if i > i1 else 'insert'
+        else:
+            while i < xdf1.nrec and j < xdf2.nrec and not xdf1.changed(i) and not xdf2.changed(j):
+                i += 1
+                j += 1
+            tag = 'equal'
+        codes.append((tag, i1, i, j1, j))
+    return codes
+
+
+def append_opcode(codes, code):
+    # Adds code to the list, merging it into the last one if they're alike
+    if codes and codes[-1][0] == code[0] and codes[-1][2] == code[1] and codes[-1][4] == code[3]:
+        tag, i1, i2, j1, j2 = codes.pop()
+        code = (tag, i1, code[2], j1, code[4])
+    if code[1] < code[2] or code[3] < code[4]:
+        codes.append(code)
+
+
+def update_opcodes(head, old, new, codes):
+    """Re-diffs just the part of new that differs from old.
+
+    codes are the opcodes for head against old. The lines that differ between
+    old and new are widened out by UPDATE_MARGIN lines, then to the nearest
+    line on either side that old had matched to head; only that window is
+    diffed again, and spliced in between the untouched opcodes around it.
+    Returns the opcodes for head against new. If the window is most of the
+    file, it's all diffed again.
+
+    The result is always a valid diff of head against new, but not always
+    the one opcodes() gives: where several alignments are equally short,
+    which one a full diff picks can depend on changes outside the window.
+    """
+    n0 = len(old)
+    n1 = len(new)
+    limit = min(n0, n1)
+    start = 0
+    while start < limit and old[start] == new[start]:
+        start += 1
+    tail = 0
+    while tail < limit - start and old[n0 - 1 - tail] == new[n1 - 1 - tail]:
+        tail += 1
+    if start == n0 == n1:
+        return codes
+    delta = n1 - n0
+
+    # the matched lines at least UPDATE_MARGIN lines either side of
+    # [start, n0 - tail) in old
+    lower = None
+    upper = None
+    for index, (tag, i1, i2, j1, j2) in enumerate(codes):
+        if tag != 'equal':
+            continue
+        if j1 < start - UPDATE_MARGIN:
+            ja = min(j2, start - UPDATE_MARGIN) - 1
+            lower = index, i1 + (ja - j1), ja
+        if j2 > n0 - tail + UPDATE_MARGIN:
+            jb = max(j1, n0 - tail + UPDATE_MARGIN)
+            upper = index, i1 + (jb - j1), jb
+            break
+    ia, ja = lower[1:] if lower else (-1, -1)
+    ib, jb = upper[1:] if upper else (len(head), n0)
+
+    if (ib - ia) + (jb - ja) > (len(head) + n0) // 2:
+        return opcodes(head, new)
+
+    result = []
+    if lower:
+        result.extend(codes[:lower[0]])
+        tag, i1, i2, j1, j2 = codes[lower[0]]
+        append_opcode(result, (tag, i1, ia + 1, j1, ja + 1))
+    for tag, i1, i2, j1, j2 in opcodes(head[ia + 1:ib], new[ja + 1:jb + delta]):
+        append_opcode(result, (tag, i1 + ia + 1, i2 + ia + 1, j1 + ja + 1, j2 + ja + 1))
+    if upper:
+        tag, i1, i2, j1, j2 = codes[upper[0]]
+        append_opcode(result, (tag, ib, i2, jb + delta, j2 + delta))
+        for tag, i1, i2, j1, j2 in codes[upper[0] + 1:]:
+            append_opcode(result, (tag, i1, i2, j1 + delta, j2 + delta))
+    return result
+
+
+def classify(old, new, codes=None):
+    """Returns the [change_type, line] annotations for going from old to new.
+
+    Both are lists of lines from split_lines(); codes are the opcodes between
+    them, if they're already known. This walks the edits the way
+    GitAnnotateCommand.parse_diff walked a unified diff of the same texts,
+    "\\ No newline at end of file" markers and all, so the two agree. The one
+    deliberate difference: parse_diff skipped hunks whose header gave only
+    one line for either side ("@@ -1 +1,2 @@"), which this doesn't.
+    """
+    diff = []
+    # state as in parse_diff: the buffer line we're at, and whether the
+    # current change has seen a (non-blank) deletion and any insertion
+    tracked = 0
+    deletion = insertion = False
+    if not new:
+        # git's hunk header says "+0,0" here, which parse_diff read as
+        # starting a line early
+        tracked = -1
+
+    if codes is None:
+        codes = opcodes(old, new)
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal':
+            # a context line closes the change before it
+            if deletion and not insertion:
+                diff.append(['-', tracked])
+            deletion = insertion = False
+            tracked += i2 - i1
+            continue
+        for line in old[i1:i2]:
+            if line.strip():
+                deletion = True
+        if i2 > i1 and i2 == len(old) and not old[-1].endswith('\n'):
+            # the marker line after it counts as context
+            if deletion and not insertion:
+                diff.append(['-', tracked])
+            deletion = insertion = False
+            tracked += 1
+        for line in new[j1:j2]:
+            if not deletion:
+                diff.append(['+', tracked])
+                insertion = True
+            elif line.strip():
+                diff.append(['x', tracked])
+                insertion = True
+            tracked += 1
+        if j2 > j1 and j2 == len(new) and not new[-1].endswith('\n'):
+            if deletion and not insertion:
+                diff.append(['-', tracked])
+            deletion = insertion = False
+            tracked += 1
+    return diff
@@ -0,0 +1,489 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import binascii
+import functools
+import hashlib
+import itertools
+import os
+import subprocess
+import threading
+from array import array
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+import sublime
+from . import git_binary, popen_options, git_dir, git_common_dir, file_stamp, scheduler, CommandScheduler, lane_size
+
+
+# How long a reader thread waits for more requests before it shuts its git
+# processes down. They're started again on the next request.
+IDLE_TIMEOUT = 60
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class ObjectReader(object):
+    """A long-lived `git cat-file --batch` (and `--batch-check`) for one repository.
+
+    Requests can come from any thread. They're queued, interactive ones ahead
+    of background ones, and answered in turn by a single reader thread which
+    hands the result to the request's callback. If git goes away it's started
+    again and the request retried once.
+    """
+    def __init__(self, root, git='git'):
+        self.root = root
+        self.git = git
+        self.requests = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.processes = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, mode, spec, callback, background=False):
+        # callback is called on the reader thread
+        priority = BACKGROUND if background else INTERACTIVE
+        self.requests.put((priority, next(self.sequence), mode, spec, callback))
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.work)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def contents(self, spec, callback, background=False):
+        """Calls back with the object's content as bytes, or None if it doesn't exist."""
+        self.submit('batch', spec, callback, background)
+
+    def info(self, spec, callback, background=False):
+        """Calls back with an (oid, type, size) tuple, or None if it doesn't exist."""
+        self.submit('batch-check', spec, callback, background)
+
+    def fetch(self, mode, spec, background=True):
+        # For worker threads: wait for the reader thread to get to it
+        done = threading.Event()
+        result = []
+
+        def callback(value):
+            result.append(value)
+            done.set()
+        self.submit(mode, spec, callback, background)
+        done.wait()
+        return result[0]
+
+    def work(self):
+        while True:
+            try:
+                priority, sequence, mode, spec, callback = self.requests.get(timeout=IDLE_TIMEOUT)
+            except queue.Empty:
+                with self.lock:
+                    if self.requests.empty():
+                        self.thread = None
+                        self.close()
+                        return
+                continue
+            try:
+                result = self.query(mode, spec)
+            except Exception as e:
+                print("Git: cat-file failed", spec, e)
+                result = None
+            try:
+                callback(result)
+            except Exception as e:
+                # the thread has to live on to answer everything else
+                print("Git: cat-file callback failed", spec, e)
+
+    def query(self, mode, spec):
+        if '\n' in spec:
+            return None
+        for attempt in range(2):
+            proc = self.process(mode)
+            try:
+                proc.stdin.write(spec.encode('utf-8') + b'\n')
+                proc.stdin.flush()
+                header = proc.stdout.readline()
+                if not header:
+                    raise IOError("cat-file exited")
+                # "<spec> missing", where the spec may have spaces in it
+                if header.rstrip(b'\n').endswith((b' missing', b' ambiguous')):
+                    return None
+                fields = header.decode('utf-8', 'replace').split()
+                if len(fields) != 3:
+                    return None
+                oid, kind, size = fields[0], fields[1], int(fields[2])
+                if mode == 'batch-check':
+                    return oid, kind, size
+                data = proc.stdout.read(size + 1)
+                if len(data) != size + 1:
+                    raise IOError("short read from cat-file")
+                return data[:size]
+            except (IOError, OSError, ValueError):
+                self.close(mode)
+        return None
+
+    def process(self, mode):
+        proc = self.processes.get(mode)
+        if proc is None or proc.poll() is not None:
+            with open(os.devnull, 'wb') as devnull:
+                proc = subprocess.Popen(
+                    [self.git, 'cat-file', '--' + mode],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=devnull, cwd=self.root,
+                    **popen_options(background=True)
+                )
+            self.processes[mode] = proc
+        return proc
+
+    def close(self, mode=None):
+        for key in list(self.processes):
+            if mode is not None and key != mode:
+                continue
+            proc = self.processes.pop(key)
+            try:
+                proc.stdin.close()
+                proc.wait()
+            except (IOError, OSError):
+                pass
+
+
+readers = {}
+
+
+def object_reader(root):
+    # Call from the main thread; git_binary() reads settings
+    git = git_binary()
+    reader = readers.get(root)
+    if reader is None or reader.git != git:
+        reader = readers[root] = ObjectReader(root, git)
+    return reader
+
+
+class LRUCache(object):
+    """A thread-safe mapping that forgets its least recently used entries.
+
+    It holds at most max_entries entries and, if max_bytes is set, at most
+    that many bytes as measured by sizeof(value).
+    """
+    def __init__(self, max_entries=256, max_bytes=None, sizeof=len):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            # move it to the most recently used end
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.sizeof(self.entries.pop(key))
+            if self.max_bytes is not None and size > self.max_bytes:
+                # would push everything else out and still not fit
+                return
+            self.entries[key] = value
+            self.size += size
+            self.evict()
+
+    def resize(self, max_entries, max_bytes=None):
+        with self.lock:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes)):
+            key, value = self.entries.popitem(last=False)
+            self.size -= self.sizeof(value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+head_cache = {}
+
+
+def head_oid(root):
+    """The commit HEAD points at, read straight from the repository's files.
+
+    This is only re-read when HEAD, the branch's ref file or packed-refs
+    change on disk, so asking is a few stats. None for an unborn branch.
+    """
+    gitdir = git_dir(root)
+    common = git_common_dir(gitdir)
+    head_path = os.path.join(gitdir, 'HEAD')
+    packed_path = os.path.join(common, 'packed-refs')
+
+    cached = head_cache.get(root)
+    if cached:
+        stamps, ref_path, oid = cached
+        if stamps == (file_stamp(head_path), file_stamp(ref_path) if ref_path else None, file_stamp(packed_path)):
+            return oid
+
+    head_stamp = file_stamp(head_path)
+    ref_path = None
+    oid = None
+    try:
+        with open(head_path) as f:
+            head = f.read().strip()
+        if head.startswith('ref:'):
+            ref = head[len('ref:'):].strip()
+            ref_path = os.path.join(gitdir if not ref.startswith('refs/') else common, *ref.split('/'))
+            oid = read_ref(ref_path, ref, packed_path)
+        else:
+            oid = head
+    except (IOError, OSError):
+        pass
+    head_cache[root] = ((head_stamp, file_stamp(ref_path) if ref_path else None, file_stamp(packed_path)), ref_path, oid)
+    return oid
+
+
+def head_ref_path(root):
+    # The loose ref file HEAD's branch lives in (which may not exist if the
+    # ref is packed), or None if HEAD is detached
+    head_oid(root)
+    return head_cache[root][1]
+
+
+def read_ref(ref_path, ref, packed_path):
+    try:
+        with open(ref_path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        pass
+    try:
+        with open(packed_path) as f:
+            for line in f:
+                if line.startswith(('#', '^')):
+                    continue
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def blob_oid(data):
+    # The id git gives data (bytes) as a blob, as `git hash-object` would
+    # work it out without any filters
+    return hashlib.sha1(b'blob ' + str(len(data)).encode('ascii') + b'\0' + data).hexdigest()
+
+
+class MissingBlob(bytes):
+    pass
+
+
+# Stands in for "not in that commit" in the blob cache, so that asking about
+# a file that's new doesn't go back to git each time
+MISSING = MissingBlob()
+
+blobs = LRUCache()
+
+
+def blob_cache():
+    # Call from the main thread to pick up changes to the settings
+    s = sublime.load_settings("Git.sublime-settings")
+    blobs.resize(s.get('blob_cache_entries', 256), s.get('blob_cache_bytes', 32 * 1024 * 1024))
+    return blobs
+
+
+def read_blob(root, commit, path, callback, background=False):
+    """Calls back with the bytes of path as of commit, or None if it isn't there.
+
+    commit may be 'HEAD', which is resolved from the repository's files, or
+    any commit-ish that always means the same commit (e.g. a hash). Results
+    are kept in the shared blob cache. If they're already there the callback
+    is called right away, on the calling thread; otherwise it's called on
+    the object reader's thread.
+    """
+    cache = blob_cache()
+    if commit == 'HEAD':
+        commit = head_oid(root)
+        if commit is None:
+            # unborn branch: nothing is in HEAD yet
+            return callback(None)
+    key = (root, commit, path)
+    data = cache.get(key)
+    if data is not None:
+        return callback(None if data is MISSING else data)
+
+    def done(data):
+        cache.set(key, MISSING if data is None else data)
+        callback(data)
+    object_reader(root).contents('%s:%s' % (commit, path), done, background=background)
+
+
+# Commit messages never change for a given commit, so they're kept by oid
+commit_messages = LRUCache(max_entries=4096)
+
+
+def commit_message(data):
+    # The message from a raw commit object, decoded as its encoding header says
+    headers, _, message = data.partition(b'\n\n')
+    encoding = 'utf-8'
+    for header in headers.split(b'\n'):
+        if header.startswith(b'encoding '):
+            encoding = header[len(b'encoding '):].decode('ascii', 'replace').strip()
+    try:
+        return message.decode(encoding, 'replace')
+    except LookupError:
+        return message.decode('utf-8', 'replace')
+
+
+def read_commit_messages(root, oids, callback, background=False):
+    """Calls back with {oid: message} for those of oids that are commits.
+
+    However many there are, they're read one after the other through the
+    repository's cat-file process, not passed to git on a command line.
+    As with read_blob, the callback is called right away if they're all
+    cached, and otherwise on the object reader's thread.
+    """
+    found = {}
+    wanted = []
+    for oid in oids:
+        message = commit_messages.get(oid)
+        if message is None:
+            wanted.append(oid)
+        else:
+            found[oid] = message
+    if not wanted:
+        return callback(found)
+
+    # the reader thread answers them in turn, so this only counts on one thread
+    remaining = [len(wanted)]
+
+    def done(oid, data):
+        if data is not None:
+            found[oid] = commit_message(data)
+            commit_messages.set(oid, found[oid])
+        remaining[0] -= 1
+        if not remaining[0]:
+            callback(found)
+    reader = object_reader(root)
+    for oid in wanted:
+        reader.contents(oid, functools.partial(done, oid), background=background)
+
+
+class TreeIndex(object):
+    """Every file in a tree, as `git ls-tree -r` lists them.
+
+    Rather than a list of strings per file, paths are kept end to end in one
+    NUL-separated buffer and oids as raw bytes in another, with an array of
+    where each path starts; so it takes little more memory than the paths
+    themselves, and listing them all is a single decode and split.
+    """
+    def __init__(self):
+        self.data = bytearray()
+        self.starts = array(str('I'))
+        self.oid_bytes = bytearray()
+        self.oid_size = 20
+        self.partial = b''
+
+    def __len__(self):
+        return len(self.starts)
+
+    def nbytes(self):
+        return len(self.data) + len(self.oid_bytes) + len(self.starts) * self.starts.itemsize
+
+    def feed(self, data):
+        # ls-tree -z output, in whatever pieces it arrives in
+        records = (self.partial + data).split(b'\0')
+        self.partial = records.pop()
+        for record in records:
+            meta, _, path = record.partition(b'\t')
+            fields = meta.split(b' ')
+            # only blobs can be opened; submodules show up as commits
+            if len(fields) != 3 or fields[1] != b'blob':
+                continue
+            oid = binascii.unhexlify(fields[2])
+            self.oid_size = len(oid)
+            self.starts.append(len(self.data))
+            self.data += path + b'\0'
+            self.oid_bytes += oid
+
+    def path(self, i):
+        start = self.starts[i]
+        return bytes(self.data[start:self.data.index(b'\0', start)]).decode('utf-8', 'replace')
+
+    def oid(self, i):
+        return binascii.hexlify(bytes(self.oid_bytes[i * self.oid_size:(i + 1) * self.oid_size])).decode('ascii')
+
+    def paths(self):
+        if not self.starts:
+            return []
+        return bytes(self.data[:-1]).decode('utf-8', 'replace').split('\0')
+
+
+# By tree oid: a tree's files never change, however many commits share it
+trees = LRUCache(max_entries=8, max_bytes=128 * 1024 * 1024, sizeof=lambda index: index.nbytes())
+
+TREE_CHUNK = 64 * 1024
+
+
+def read_tree_index(root, commit, callback):
+    """Calls back with a TreeIndex of the files in commit, or None if there's no such commit.
+
+    Call from the main thread. The callback is called right away if the
+    commit's tree is in the cache, and otherwise on another thread; the
+    tree is listed on the repository's interactive lane and parsed as it
+    streams in.
+    """
+    git = git_binary()
+    size = lane_size(CommandScheduler.INTERACTIVE)
+
+    def resolved(info):
+        if info is None or info[1] != 'tree':
+            return callback(None)
+        tree = info[0]
+        index = trees.get(tree)
+        if index is not None:
+            return callback(index)
+        scheduler.submit(root, CommandScheduler.INTERACTIVE, functools.partial(list_tree, tree), size)
+
+    def list_tree(tree):
+        index = TreeIndex()
+        try:
+            with open(os.devnull, 'wb') as devnull:
+                proc = subprocess.Popen(
+                    [git, 'ls-tree', '-r', '-z', '--full-tree', tree],
+                    stdin=devnull, stdout=subprocess.PIPE, stderr=devnull,
+                    cwd=root, **popen_options()
+                )
+            fd = proc.stdout.fileno()
+            while True:
+                data = os.read(fd, TREE_CHUNK)
+                if not data:
+                    break
+                index.feed(data)
+            proc.stdout.close()
+            if proc.wait() != 0:
+                index = None
+        except (IOError, OSError, ValueError, binascii.Error) as e:
+            print("Git: ls-tree failed", tree, e)
+            index = None
+        if index is not None:
+            trees.set(tree, index)
+        callback(index)
+    object_reader(root).info(commit + '^{tree}', resolved)
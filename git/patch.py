@@ -0,0 +1,268 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import re
+from bisect import bisect_left
+
+
+# Reading unified diffs - `git diff` output, or a Git Diff view's contents -
+# into files and hunks, finding the hunks a selection touches, and putting a
+# patch for `git apply` back together from just those.
+
+HUNK_HEADER = re.compile(r'^@@ -([0-9]*)(?:,([0-9]*))? \+([0-9]*)(?:,([0-9]*))? @@(.*)', re.DOTALL)
+
+
+class FileDiff(object):
+    __slots__ = ('header', 'hunks')
+
+    def __init__(self):
+        # the lines from `diff --git` up to the first hunk
+        self.header = []
+        self.hunks = []
+
+
+class Hunk(object):
+    """One hunk, from its @@ line to the line before the next.
+
+    start and end are the lines of the new file it covers, as the @@ line
+    gives them; diff_start and diff_end are the (1-based) lines of the diff
+    it takes up.
+    """
+    __slots__ = ('file', 'lines', 'start', 'end', 'diff_start', 'diff_end', 'old_start', 'heading')
+
+    def __init__(self, file, start, end, diff_start, old_start=0, heading=''):
+        self.file = file
+        self.lines = []
+        self.start = start
+        self.end = end
+        self.diff_start = diff_start
+        self.diff_end = diff_start
+        self.old_start = old_start
+        # whatever follows the second @@, usually the enclosing function
+        self.heading = heading
+
+    def partial(self, selection, direct=False, offset=0):
+        """The hunk cut down to the changed lines selection (a LineSelection) touches.
+
+        Unselected additions are dropped and unselected removals kept as
+        context, as `git add -p` does when a hunk is edited by hand, and
+        the @@ line is worked out again, with offset (how many lines the
+        hunks before this one add to the file) moving the new side along.
+        Returns (lines, how many lines this one adds), or None if none of
+        its changes are selected.
+        """
+        lines = []
+        old_count = new_count = 0
+        changed = False
+        # the line of the new file the next line of the hunk is at
+        new_line = self.start
+        kept = True
+        converted = False
+        # where a removed last line with no newline was kept as context;
+        # nothing can follow that, so staging an addition after it stages
+        # the removal too
+        last_line = None
+        for i, line in enumerate(self.lines[1:]):
+            kind = line[:1]
+            if kind == '\\':
+                # "\ No newline at end of file" goes with the line before
+                if kept:
+                    if converted:
+                        last_line = len(lines) - 1
+                    lines.append(line)
+                continue
+            if direct:
+                first = last = self.diff_start + 1 + i
+            elif kind == '-':
+                # where a removal shows in the file: between two lines
+                first, last = new_line - 1, new_line
+            else:
+                first = last = new_line
+            wanted = kind in '+-' and selection.touches(first, last)
+            kept = True
+            converted = False
+            if kind == '+':
+                new_line += 1
+                if wanted:
+                    if last_line is not None:
+                        lines[last_line] = '-' + lines[last_line][1:]
+                        new_count -= 1
+                        last_line = None
+                    lines.append(line)
+                    new_count += 1
+                    changed = True
+                else:
+                    kept = False
+            elif kind == '-':
+                old_count += 1
+                if wanted:
+                    lines.append(line)
+                    changed = True
+                else:
+                    lines.append(' ' + line[1:])
+                    new_count += 1
+                    converted = True
+            else:
+                new_line += 1
+                lines.append(line)
+                old_count += 1
+                new_count += 1
+        if not changed:
+            return None
+        # an empty side is numbered by the line before it
+        old_start = self.old_start
+        new_start = old_start + offset
+        if old_count == 0 and new_count:
+            new_start += 1
+        elif new_count == 0 and old_count:
+            new_start -= 1
+        header = '@@ -%d,%d +%d,%d @@%s' % (old_start, old_count, new_start, new_count, self.heading)
+        return [header] + lines, new_count - old_count
+
+
+class Diff(object):
+    def __init__(self):
+        # anything before the first file, e.g. a Git Diff view's root header
+        self.preamble = []
+        self.files = []
+
+    @property
+    def hunks(self):
+        return [hunk for file in self.files for hunk in file.hunks]
+
+    def select(self, ranges, direct=False):
+        """The hunks any of the (first, last) ranges of lines touch.
+
+        Lines of the diff itself (direct) are one sequence for every file;
+        lines of the files are looked for in each file's hunks.
+        """
+        if direct:
+            return HunkIndex(self.hunks, direct=True).select(ranges)
+        selected = set()
+        for file in self.files:
+            selected.update(HunkIndex(file.hunks).select(ranges))
+        return selected
+
+    def patch(self, hunks):
+        # The diff cut down to the given hunks, in one join
+        wanted = set(hunks)
+        parts = list(self.preamble)
+        for file in self.files:
+            chosen = [hunk for hunk in file.hunks if hunk in wanted]
+            if chosen:
+                parts.extend(file.header)
+                for hunk in chosen:
+                    parts.extend(hunk.lines)
+        return ''.join(parts)
+
+    def partial_patch(self, selection, direct=False):
+        """A patch of just the added and removed lines selection touches.
+
+        Files being deleted are left out unless every line is selected, as
+        anything less would leave git a deletion it can't make sense of.
+        """
+        wanted = self.select(selection.ranges, direct)
+        parts = list(self.preamble)
+        for file in self.files:
+            offset = 0
+            hunks = []
+            whole = True
+            for hunk in file.hunks:
+                if hunk not in wanted:
+                    whole = False
+                    continue
+                result = hunk.partial(selection, direct, offset)
+                if result is None:
+                    whole = False
+                    continue
+                lines, delta = result
+                whole = whole and lines[1:] == hunk.lines[1:]
+                offset += delta
+                hunks.append(lines)
+            if not hunks or (not whole and any(line.startswith('deleted file mode') for line in file.header)):
+                continue
+            parts.extend(file.header)
+            for lines in hunks:
+                parts.extend(lines)
+        return ''.join(parts) if len(parts) > len(self.preamble) else ''
+
+
+def parse_diff(text):
+    # keeping line endings as they are, or the patch won't apply
+    diff = Diff()
+    section = diff.preamble
+    file = None
+    hunk = None
+    for line_num, line in enumerate(text.splitlines(True)):
+        if line.startswith('diff'):
+            file = FileDiff()
+            diff.files.append(file)
+            section = file.header
+            hunk = None
+        elif line.startswith('@@') and file is not None:
+            match = HUNK_HEADER.match(line)
+            if match:
+                start = int(match.group(3))
+                end = start + int(match.group(4)) if match.group(4) else start
+                hunk = Hunk(file, start, end, line_num + 1, int(match.group(1)), match.group(5))
+                file.hunks.append(hunk)
+                section = hunk.lines
+        elif hunk is not None:
+            hunk.diff_end = line_num + 1
+        section.append(line)
+    return diff
+
+
+class LineSelection(object):
+    # Sorted, merged (first, last) ranges of lines, to ask whether any of a
+    # run of lines is selected in a bisect
+    def __init__(self, ranges):
+        self.ranges = []
+        for first, last in sorted(ranges):
+            if self.ranges and first <= self.ranges[-1][1] + 1:
+                self.ranges[-1] = (self.ranges[-1][0], max(last, self.ranges[-1][1]))
+            else:
+                self.ranges.append((first, last))
+        self.ends = [last for first, last in self.ranges]
+
+    def touches(self, first, last):
+        i = bisect_left(self.ends, first)
+        return i < len(self.ranges) and self.ranges[i][0] <= last
+
+
+class HunkIndex(object):
+    """Hunks sorted by where they start, to find those a range of lines touches.
+
+    By default hunks are placed by the lines of the file they cover; with
+    direct set, by the lines of the diff itself, for selections made in a
+    view showing the diff. Either way the hunks mustn't overlap - they're
+    parse_diff's, and if placed by file lines, all from one file - so that
+    their ends are in order too, and the first one a range can touch is a
+    bisect away. Overlapping hunks are a ValueError.
+    """
+    def __init__(self, hunks, direct=False):
+        if direct:
+            spans = [(hunk.diff_start, hunk.diff_end, hunk) for hunk in hunks]
+        else:
+            spans = [(hunk.start, hunk.end, hunk) for hunk in hunks]
+        spans.sort(key=lambda span: span[:2])
+        self.starts = [span[0] for span in spans]
+        self.ends = [span[1] for span in spans]
+        self.hunks = [span[2] for span in spans]
+        # end is where the next hunk could start (one past the last line, or
+        # for an empty side the line it follows) so it may be shared
+        for i in range(1, len(spans)):
+            if self.starts[i] < self.ends[i - 1]:
+                raise ValueError("hunks overlap at line %d" % self.starts[i])
+
+    def overlapping(self, first, last):
+        i = bisect_left(self.ends, first)
+        while i < len(self.hunks) and self.starts[i] <= last:
+            yield self.hunks[i]
+            i += 1
+
+    def select(self, ranges):
+        # The hunks touched by any of the (first, last) ranges, each once
+        selected = set()
+        for first, last in ranges:
+            selected.update(self.overlapping(first, last))
+        return selected
@@ -0,0 +1,136 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+from collections import namedtuple
+from functools import partial
+
+# Reading `git status --porcelain=v2 -z [--branch]`. Paths come out exactly as
+# they are (no quoting), relative to the repository root, and renames give
+# both sides separately, so nothing needs slicing or unquoting afterwards.
+#
+# Codes are given the way `--porcelain` (v1) shows them: a space for
+# unmodified rather than v2's '.', and '??' / '!!' for untracked and ignored
+# files, which is what everything here already expects.
+
+
+class StatusEntry(namedtuple(str('StatusEntry'), str('index worktree path orig_path submodule'))):
+    # index and worktree are the two status codes; orig_path is where a
+    # renamed or copied file came from; submodule is v2's four-letter
+    # submodule state (e.g. 'SC..'), or None if it isn't one
+    __slots__ = ()
+
+    def __new__(cls, index, worktree, path, orig_path=None, submodule=None):
+        return tuple.__new__(cls, (index, worktree, path, orig_path, submodule))
+
+    @property
+    def status(self):
+        return self.index + self.worktree
+
+    @property
+    def unmerged(self):
+        return self.index == 'U' or self.worktree == 'U' or self.status in ('AA', 'DD')
+
+    def line(self):
+        # as `git status --porcelain` would show it, less the quoting
+        if self.orig_path is not None:
+            return "%s %s -> %s" % (self.status, self.orig_path, self.path)
+        return "%s %s" % (self.status, self.path)
+
+    def __repr__(self):
+        return "StatusEntry(%r)" % self.line()
+
+
+class BranchInfo(object):
+    __slots__ = ('oid', 'head', 'upstream', 'ahead', 'behind')
+
+    def __init__(self):
+        self.oid = None
+        self.head = None
+        self.upstream = None
+        self.ahead = 0
+        self.behind = 0
+
+    @property
+    def detached(self):
+        return self.head == '(detached)'
+
+    @property
+    def unborn(self):
+        return self.oid == '(initial)'
+
+    def header(self, line):
+        key, _, value = line[len('# '):].partition(' ')
+        if key == 'branch.oid':
+            self.oid = value
+        elif key == 'branch.head':
+            self.head = value
+        elif key == 'branch.upstream':
+            self.upstream = value
+        elif key == 'branch.ab':
+            ahead, behind = value.split()
+            self.ahead = int(ahead)
+            self.behind = -int(behind)
+
+
+# Makes a StatusEntry straight from a tuple of all five fields. Creating the
+# entries is most of the time a large status takes, and this skips the
+# Python-level __new__.
+make_entry = partial(tuple.__new__, StatusEntry)
+
+
+def code(c):
+    return ' ' if c == '.' else c
+
+
+# Where the fixed-width part of each kind of record ends: the kind, XY, the
+# submodule state, and three (or, unmerged, four) six-digit modes. The object
+# ids come next, then the path; only the ids' length varies, with the hash.
+ORDINARY_MODES_END = len('1 XY SSSS 100644 100644 100644 ')
+UNMERGED_MODES_END = len('u XY SSSS 100644 100644 100644 100644 ')
+
+
+def parse_status(output, branch=None):
+    """Yields a StatusEntry for each file in `git status --porcelain=v2 -z` output.
+
+    If branch (a BranchInfo) is given, the `--branch` headers are read into
+    it as they go past. Anything that isn't a record - stderr ends up mixed
+    into the output - is skipped.
+    """
+    # Paths are found from the length of the first object id rather than by
+    # splitting every record into fields; most of a large status is '1' and
+    # '?' records, and this keeps each of those to a few slices.
+    fields = iter(output.split('\0'))
+    for field in fields:
+        kind = field[:2]
+        if kind == '1 ':
+            oid_end = field.find(' ', ORDINARY_MODES_END)
+            start = 2 * oid_end - ORDINARY_MODES_END + 2
+            if oid_end != -1 and len(field) > start:
+                x = field[2]
+                y = field[3]
+                sub = field[5:9]
+                yield make_entry((' ' if x == '.' else x, ' ' if y == '.' else y, field[start:],
+                                  None, None if sub[:1] == 'N' else sub))
+        elif kind == '2 ':
+            # the path it was renamed or copied from is the next field
+            orig_path = next(fields, None)
+            oid_end = field.find(' ', ORDINARY_MODES_END)
+            score_end = field.find(' ', 2 * oid_end - ORDINARY_MODES_END + 2)
+            if oid_end != -1 and score_end != -1:
+                yield make_entry((code(field[2]), code(field[3]), field[score_end + 1:],
+                                  orig_path, submodule(field[5:9])))
+        elif kind == 'u ':
+            oid_end = field.find(' ', UNMERGED_MODES_END)
+            start = 3 * oid_end - 2 * UNMERGED_MODES_END + 3
+            if oid_end != -1 and len(field) > start:
+                yield make_entry((field[2], field[3], field[start:], None, submodule(field[5:9])))
+        elif kind == '? ':
+            yield make_entry(('?', '?', field[2:], None, None))
+        elif kind == '! ':
+            yield make_entry(('!', '!', field[2:], None, None))
+        elif kind == '# ':
+            if branch is not None:
+                branch.header(field)
+
+
+def submodule(state):
+    return None if state.startswith('N') else state
@@ -50,10 +50,10 @@ class GitBranchCommand(GitWindowCommand):
         if picked_branch.startswith("*"):
             return
         picked_branch = picked_branch.strip()
-        self.run_command(['git'] + self.command_to_run_after_branch + [picked_branch], self.update_status)
+        self.run_command(['git'] + self.command_to_run_after_branch + [picked_branch], self.update_status, changes_files=True)
 
-    def update_status(self, result):
-        self.panel(result)
+    def update_status(self, result, **kwargs):
+        self.generic_done(result, **kwargs)
         global branch
         branch = ""
         for view in self.window.views():
@@ -70,6 +70,8 @@ class GitDeleteBranchCommand(GitBranchCommand):
 
 
 class GitNewBranchCommand(GitWindowCommand):
+    may_change_files = True
+
     def run(self):
         self.get_window().show_input_panel(
             "Branch name", "",
@@ -136,6 +138,8 @@ class GitShowTagsCommand(GitWindowCommand):
 
 
 class GitCheckoutTagCommand(GitWindowCommand):
+    may_change_files = True
+
     def run(self):
         self.run_command(['git', 'tag'], self.fetch_tag)
 
@@ -155,6 +159,7 @@ class GitCheckoutTagCommand(GitWindowCommand):
 
 
 class GitPullCurrentBranchCommand(GitWindowCommand):
+    may_change_files = True
     command_to_run_after_describe = 'pull'
 
     def run(self):
@@ -180,4 +185,5 @@ class GitPullCurrentBranchCommand(GitWindowCommand):
 
 
 class GitPushCurrentBranchCommand(GitPullCurrentBranchCommand):
+    may_change_files = False
     command_to_run_after_describe = 'push'
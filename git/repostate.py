@@ -0,0 +1,202 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import functools
+import os
+
+import sublime
+from . import CommandThread, git_binary, git_dir, git_common_dir, file_stamp, do_when
+from .objects import head_oid, head_ref_path
+from .porcelain import BranchInfo, parse_status
+
+
+class RepoState(object):
+    """What the status bar knows about one repository, shared by all its views.
+
+    Asking for it is a handful of stats: git only runs again once HEAD, the
+    index, the current branch's ref or packed-refs have changed on disk, or
+    once something has called invalidate() (after a save, say, or a command
+    that may have changed files).
+    """
+    def __init__(self, root):
+        self.root = root
+        self.stamps = None
+        # a BranchInfo, and {code: count} for the index and the working tree
+        # (None until status has been asked for)
+        self.branch = None
+        self.index = None
+        self.worktree = None
+        self.refreshing = False
+        self.invalidated = False
+        self.waiting = []
+        self.thread = None
+
+    def fingerprint(self):
+        gitdir = git_dir(self.root)
+        common = git_common_dir(gitdir)
+        ref_path = head_ref_path(self.root)
+        return (
+            file_stamp(os.path.join(gitdir, 'HEAD')),
+            file_stamp(os.path.join(gitdir, 'index')),
+            file_stamp(os.path.join(common, 'packed-refs')),
+            file_stamp(ref_path) if ref_path else None,
+        )
+
+    def invalidate(self):
+        self.stamps = None
+        # if a refresh is under way, what it finds may already be out of date
+        self.invalidated = True
+
+    def request(self, callback, status=True):
+        # callback(state), straight away if what we have is current
+        stamps = self.fingerprint()
+        if stamps == self.stamps and (self.index is not None or not status):
+            return callback(self)
+        self.waiting.append((callback, status))
+        if not self.refreshing:
+            self.refresh(stamps)
+
+    def refresh(self, stamps):
+        self.refreshing = True
+        self.invalidated = False
+        with_status = any(status for callback, status in self.waiting)
+        command = [git_binary(), 'status', '--porcelain=v2', '-z', '--branch']
+        if not with_status:
+            # only the branch headers are wanted
+            command.append('--untracked-files=no')
+        thread = self.thread = CommandThread(
+            command, self.status_done, working_dir=self.root,
+            error_suppresses_output=True, background=True,
+            stamps=stamps, with_status=with_status
+        )
+        thread.start()
+        # status_done isn't called if git couldn't be run or the repository
+        # has gone, and the refresh has to end either way
+        do_when(lambda: thread.finished, self.thread_finished, thread)
+
+    def status_done(self, result, stamps, with_status):
+        # one pass over the output for everything the status bar shows
+        branch = BranchInfo()
+        index = {}
+        worktree = {}
+        for entry in parse_status(result, branch):
+            if entry.index != ' ':
+                index[entry.index] = index.get(entry.index, 0) + 1
+            if entry.worktree != ' ':
+                worktree[entry.worktree] = worktree.get(entry.worktree, 0) + 1
+        self.branch = branch
+        self.index = index if with_status else None
+        self.worktree = worktree if with_status else None
+        self.refreshed(stamps)
+
+    def thread_finished(self, thread):
+        if not self.refreshing or self.thread is not thread:
+            return
+        # Nothing to show; what's waiting is answered with that rather than
+        # asked again, which would only fail again straight away
+        self.refreshing = False
+        self.branch = BranchInfo()
+        self.index = None
+        self.worktree = None
+        self.stamps = None
+        waiting, self.waiting = self.waiting, []
+        for callback, status in waiting:
+            callback(self)
+
+    def refreshed(self, stamps):
+        self.refreshing = False
+        self.stamps = None if self.invalidated else stamps
+        waiting, self.waiting = self.waiting, []
+        for callback, status in waiting:
+            self.request(callback, status)
+
+
+repo_states = {}
+
+
+def repo_state(root):
+    state = repo_states.get(root)
+    if state is None:
+        state = repo_states[root] = RepoState(root)
+    return state
+
+
+def invalidate_repo_state(root):
+    state = repo_states.get(root)
+    if state is not None:
+        state.invalidate()
+
+
+# Reloading the open files a command has changed, rather than just the
+# active view whether or not it changed.
+
+RELOAD_BATCH = 8
+
+
+def open_file_views(root):
+    # (view, path relative to root with '/'s) for every file open in the repository
+    views = []
+    prefix = os.path.join(root, '')
+    for window in sublime.windows():
+        for view in window.views():
+            file_name = view.file_name()
+            if not file_name:
+                continue
+            path = os.path.realpath(file_name)
+            if path.startswith(prefix):
+                views.append((view, os.path.relpath(path, root).replace('\\', '/')))
+    return views
+
+
+class FilesSnapshot(object):
+    """HEAD and the stamps of the repository's open files, taken before a
+    command that may change files.
+
+    changed() then works out which of those views need reloading: those
+    whose files differ on disk from before, plus (if HEAD has moved) those
+    `git diff-tree` says differ between the two commits.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.head = head_oid(root)
+        self.stamps = dict((view.id(), file_stamp(view.file_name())) for view, path in open_file_views(root))
+
+    def changed(self, callback):
+        # callback(views) on the main thread
+        views = open_file_views(self.root)
+        changed = set(view.id() for view, path in views if view.id() in self.stamps and file_stamp(view.file_name()) != self.stamps[view.id()])
+        head = head_oid(self.root)
+        if not self.head or not head or head == self.head:
+            return callback([view for view, path in views if view.id() in changed])
+        CommandThread(
+            [git_binary(), 'diff-tree', '-r', '--name-only', '-z', self.head, head],
+            self.diff_tree_done, working_dir=self.root, error_suppresses_output=True,
+            views=views, changed=changed, on_changed=callback
+        ).start()
+
+    def diff_tree_done(self, result, views, changed, on_changed):
+        paths = set(result.split('\0'))
+        on_changed([view for view, path in views if view.id() in changed or path in paths])
+
+
+def reload_views(views):
+    # A batch at a time, so that a checkout touching lots of open files
+    # doesn't hold everything up; each keeps its place
+    for view in views[:RELOAD_BATCH]:
+        if not os.path.exists(view.file_name()):
+            # deleted; leave what was in it for the user to see
+            continue
+        position = view.viewport_position()
+        view.run_command('revert')
+        do_when(functools.partial(loaded, view), functools.partial(reloaded, view, position))
+    if views[RELOAD_BATCH:]:
+        sublime.set_timeout(functools.partial(reload_views, views[RELOAD_BATCH:]), 0)
+
+
+def loaded(view):
+    return not view.is_loading()
+
+
+def reloaded(view, position):
+    view.set_viewport_position(position, False)
+    if view.settings().get('live_git_annotations'):
+        view.run_command('git_annotate')
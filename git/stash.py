@@ -30,7 +30,8 @@ class GitStashCommand(GitWindowCommand):
 
         # get the stash ref (e.g. stash@{3})
         stash = self.results[picked].split(':')[0]
-        self.run_command(['git', 'stash'] + self.command_to_run_after_list + [stash], self.handle_command or self.generic_done, stash=stash)
+        self.run_command(['git', 'stash'] + self.command_to_run_after_list + [stash], self.handle_command, stash=stash,
+                         changes_files=self.may_change_files)
 
     def handle_command(self, result, stash, **kw):
         return self.generic_done(result, **kw)
@@ -1,20 +1,21 @@
 from __future__ import absolute_import, unicode_literals, print_function, division
 
 import os
-import re
 
 import sublime
 from . import GitWindowCommand, git_root
+from .porcelain import parse_status
 
 
 class GitStatusCommand(GitWindowCommand):
     force_open = False
 
     def run(self):
-        self.run_command(['git', 'status', '--porcelain'], self.status_done)
+        self.run_command(['git', 'status', '--porcelain=v2', '-z'], self.status_done)
 
     def status_done(self, result):
-        self.results = list(filter(self.status_filter, result.rstrip().split('\n')))
+        self.entries = list(filter(self.status_filter, parse_status(result)))
+        self.results = [entry.line() for entry in self.entries]
         if len(self.results):
             self.show_status_list()
         else:
@@ -26,22 +27,20 @@ class GitStatusCommand(GitWindowCommand):
             sublime.MONOSPACE_FONT
         )
 
-    def status_filter(self, item):
+    def status_filter(self, entry):
         # for this class we don't actually care
-        if not re.match(r'^[ MADRCU?!]{1,2}\s+.*', item):
-            return False
-        return len(item) > 0
+        return True
 
     def panel_done(self, picked):
         if 0 > picked < len(self.results):
             return
-        picked_file = self.results[picked]
-        if isinstance(picked_file, (list, tuple)):
-            picked_file = picked_file[0]
-        # first 2 characters are status codes, the third is a space
-        picked_status = picked_file[:2]
-        picked_file = picked_file[3:]
-        self.panel_followup(picked_status, picked_file, picked)
+        # subclasses may have put extra choices ahead of the files
+        extra = len(self.results) - len(self.entries)
+        if picked < extra:
+            self.panel_followup(None, None, picked)
+            return
+        entry = self.entries[picked - extra]
+        self.panel_followup(entry.status, entry.path, picked)
 
     def panel_followup(self, picked_status, picked_file, picked_index):
         # split out solely so I can override it for laughs
@@ -58,12 +57,12 @@ class GitStatusCommand(GitWindowCommand):
         else:
             if s.get('diff_tool'):
                 self.run_command(
-                    ['git', 'difftool', '--', picked_file.strip('"')],
+                    ['git', 'difftool', '--', picked_file],
                     working_dir=root
                 )
             else:
                 self.run_command(
-                    ['git', 'diff', '--no-color', '--', picked_file.strip('"')],
+                    ['git', 'diff', '--no-color', '--', picked_file],
                     self.diff_done, working_dir=root
                 )
 
@@ -1,10 +1,9 @@
 from __future__ import absolute_import, unicode_literals, print_function, division
 
-import re
-
 import sublime
 import sublime_plugin
-from . import GitTextCommand
+from . import GitTextCommand, git_root
+from .repostate import repo_state
 
 
 class GitBranchStatusListener(sublime_plugin.EventListener):
@@ -12,56 +11,61 @@ class GitBranchStatusListener(sublime_plugin.EventListener):
         view.run_command("git_branch_status")
 
     def on_post_save(self, view):
-        view.run_command("git_branch_status")
+        # the file on disk just changed, which git's own files won't show
+        view.run_command("git_branch_status", {"invalidate": True})
 
 
 class GitBranchStatusCommand(GitTextCommand):
-    def run(self, view):
+    # Reads from the repository's shared RepoState, so switching between
+    # views only runs git if something has actually changed.
+    def run(self, view, invalidate=False):
         s = sublime.load_settings("Git.sublime-settings")
-        if s.get("statusbar_branch"):
-            self.run_command(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], self.branch_done, show_status=False, no_save=True, error_suppresses_output=True)
-        else:
+        if not s.get("statusbar_branch") and not s.get("statusbar_status"):
             self.branch_done(False)
-        if (s.get("statusbar_status")):
-            self.run_command(['git', 'status', '--porcelain'], self.status_done, show_status=False, no_save=True, error_suppresses_output=True)
-        else:
             self.status_done(False)
+            return
+        state = repo_state(git_root(self.get_working_dir()))
+        if invalidate:
+            state.invalidate()
+        state.request(self.state_done, status=bool(s.get("statusbar_status")))
 
-    def branch_done(self, result):
-        if result is False:
+    def state_done(self, state):
+        s = sublime.load_settings("Git.sublime-settings")
+        self.branch_done(state.branch if s.get("statusbar_branch") else False)
+        self.status_done((state.index, state.worktree) if s.get("statusbar_status") else False)
+
+    def branch_done(self, branch):
+        if branch is False or branch.head is None:
             self.view.set_status("git-branch", "")
+            return
+        s = sublime.load_settings("Git.sublime-settings")
+        symbols = s.get("statusbar_status_symbols")
+        if branch.detached:
+            name = "(detached at %s)" % branch.oid[:7]
         else:
-            self.view.set_status("git-branch", "Git branch: " + result.strip())
+            name = branch.head
+        if branch.ahead:
+            name += " %d%s" % (branch.ahead, symbols.get('ahead', '\u2191'))
+        if branch.behind:
+            name += " %d%s" % (branch.behind, symbols.get('behind', '\u2193'))
+        self.view.set_status("git-branch", "Git branch: " + name)
 
-    def status_done(self, result):
-        if result is False:
+    def status_done(self, counts):
+        if counts is False or counts[0] is None:
             self.view.set_status("git-status-index", "")
             self.view.set_status("git-status-working", "")
         else:
-            lines = [line for line in result.splitlines() if re.match(r'^[ MADRCU?!]{1,2}\s+.*', line)]
-            index = [line[0] for line in lines if not line[0].isspace()]
-            working = [line[1] for line in lines if not line[1].isspace()]
+            index, working = counts
             self.view.set_status("git-status-index", "index: " + self.status_string(index))
             self.view.set_status("git-status-working", "working: " + self.status_string(working))
 
-    def status_string(self, statuses):
+    def status_string(self, counts):
         s = sublime.load_settings("Git.sublime-settings")
         symbols = s.get("statusbar_status_symbols")
-        if not statuses:
+        if not counts:
             return symbols['clean']
         status = []
-        if statuses.count('M'):
-            status.append("%d%s" % (statuses.count('M'), symbols['modified']))
-        if statuses.count('A'):
-            status.append("%d%s" % (statuses.count('A'), symbols['added']))
-        if statuses.count('D'):
-            status.append("%d%s" % (statuses.count('D'), symbols['deleted']))
-        if statuses.count('?'):
-            status.append("%d%s" % (statuses.count('?'), symbols['untracked']))
-        if statuses.count('U'):
-            status.append("%d%s" % (statuses.count('U'), symbols['conflicts']))
-        if statuses.count('R'):
-            status.append("%d%s" % (statuses.count('R'), symbols['renamed']))
-        if statuses.count('C'):
-            status.append("%d%s" % (statuses.count('C'), symbols['copied']))
+        for code, name in (('M', 'modified'), ('A', 'added'), ('D', 'deleted'), ('?', 'untracked'), ('U', 'conflicts'), ('R', 'renamed'), ('C', 'copied')):
+            if counts.get(code):
+                status.append("%d%s" % (counts[code], symbols[name]))
         return symbols['separator'].join(status)
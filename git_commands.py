@@ -21,17 +21,24 @@ if sys.version_info >= (3,):
 # Modules have to be reloaded in dependency order. So list 'em here:
 mods_load_order = [
     '',
+    '.objects',
+    '.linediff',
+    '.patch',
+    '.porcelain',
+    '.repostate',
+    '.commits',
+    '.blame',
 
     '.status',
-    '.add',  # imports status
+    '.diff',
+    '.add',  # imports status, diff
     '.index',  # imports status
     '.commit',  # imports add
+    '.annotate',  # imports add
 
-    # no interdependencies below
+    # nothing imports these
     '.core',
-    '.annotate',
     '.config',
-    '.diff',
     '.history',
     '.ignore',
     '.repo',
@@ -61,6 +68,7 @@ try:
     from .git.add import *  # noqa
     from .git.index import *  # noqa
     from .git.annotate import *  # noqa
+    from .git.blame import *  # noqa
     from .git.config import *  # noqa
     from .git.commit import *  # noqa
     from .git.diff import *  # noqa
@@ -79,6 +87,7 @@ except (ImportError, ValueError):
     from git.add import *  # noqa
     from git.index import *  # noqa
     from git.annotate import *  # noqa
+    from git.blame import *  # noqa
     from git.config import *  # noqa
     from git.commit import *  # noqa
     from git.diff import *  # noqa
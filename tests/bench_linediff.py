@@ -0,0 +1,34 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+# Times re-annotating a large buffer after a one-line edit: diffing it all
+# against HEAD again, and linediff.update_opcodes re-diffing just the edit.
+#
+#   python tests/bench_linediff.py [lines] [changes]
+
+import random
+import sys
+import timeit
+
+from util import GIT_DIR  # noqa
+import linediff
+
+
+def main(lines=50000, changes=400):
+    rng = random.Random(0)
+    head = ['line %d %s\n' % (i, rng.choice(['x = 1', 'pass', '', '}'])) for i in range(lines)]
+    old = list(head)
+    for i in sorted(rng.sample(range(lines), changes), reverse=True):
+        old[i:i + 1] = ['changed %d\n' % i, 'added %d\n' % i]
+    codes = linediff.opcodes(head, old)
+    new = list(old)
+    new[len(new) // 2] = 'edited\n'
+
+    full = min(timeit.repeat(lambda: linediff.opcodes(head, new), number=1, repeat=3))
+    update = min(timeit.repeat(lambda: linediff.update_opcodes(head, old, new, codes), number=1, repeat=3))
+    same = linediff.update_opcodes(head, old, new, codes) == linediff.opcodes(head, new)
+    print('%d lines, %d changes: full diff %.1f ms, update %.1f ms, same opcodes: %s'
+          % (lines, changes, full * 1000, update * 1000, same))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
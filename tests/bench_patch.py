@@ -0,0 +1,53 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+# Times finding the hunks a multiple selection touches in a large diff, with
+# patch.HunkIndex and the way cull_diff used to: every selection against
+# every hunk.
+#
+#   python tests/bench_patch.py [hunks] [selections]
+
+import random
+import sys
+import timeit
+
+from util import GIT_DIR  # noqa
+import patch
+
+
+def big_diff(hunks):
+    # one file, a changed line every 10 lines, with a line of context
+    lines = ['diff --git a/big.txt b/big.txt\n', '--- a/big.txt\n', '+++ b/big.txt\n']
+    for i in range(hunks):
+        line = 10 * i + 2
+        lines.extend([
+            '@@ -%d,3 +%d,3 @@\n' % (line - 1, line - 1),
+            ' context %d\n' % i, '-old %d\n' % i, '+new %d\n' % i, ' context %d\n' % i,
+        ])
+    return ''.join(lines)
+
+
+def linear_select(diff, ranges, direct=False):
+    selected = set()
+    for hunk in diff.hunks:
+        start, end = (hunk.diff_start, hunk.diff_end) if direct else (hunk.start, hunk.end)
+        for first, last in ranges:
+            if last >= start and first <= end:
+                selected.add(hunk)
+    return selected
+
+
+def main(hunks=20000, selections=2000):
+    diff = patch.parse_diff(big_diff(hunks))
+    rng = random.Random(0)
+    cursors = [(line, line) for line in (rng.randint(1, 10 * hunks) for _ in range(selections))]
+    for direct in (False, True):
+        indexed = diff.select(cursors, direct)
+        assert indexed == linear_select(diff, cursors, direct)
+        index = min(timeit.repeat(lambda: diff.select(cursors, direct), number=1, repeat=5))
+        linear = min(timeit.repeat(lambda: linear_select(diff, cursors, direct), number=1, repeat=3))
+        print('%d hunks, %d cursors%s: index %.1f ms, linear %.1f ms, %d hunks selected'
+              % (hunks, selections, ' (diff lines)' if direct else '', index * 1000, linear * 1000, len(indexed)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,84 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+# Times porcelain.parse_status on a large `git status --porcelain=v2 -z`
+# listing, against what status used to do with the same files listed by
+# `git status --porcelain`: split the lines and regex-filter them.
+#
+#   python tests/bench_porcelain.py [entries]
+
+import random
+import re
+import sys
+import timeit
+
+from util import GIT_DIR  # noqa
+import porcelain
+
+OID = '0123456789abcdef0123456789abcdef01234567'
+
+
+def listings(entries):
+    rng = random.Random(0)
+    v1 = []
+    v2 = ['# branch.oid %s' % OID, '# branch.head master']
+    for i in range(entries):
+        path = 'src/module%d/file %d.py' % (i % 100, i)
+        kind = rng.random()
+        if kind < 0.6:
+            xy = rng.choice(['.M', 'M.', 'MM', 'A.', 'D.'])
+            v1.append('%s %s' % (xy.replace('.', ' '), path))
+            v2.append('1 %s N... 100644 100644 100644 %s %s %s' % (xy, OID, OID, path))
+        elif kind < 0.7:
+            v1.append('R  old%d.py -> %s' % (i, path))
+            v2.append('2 R. N... 100644 100644 100644 %s %s R100 %s' % (OID, OID, path))
+            v2.append('old%d.py' % i)
+        elif kind < 0.75:
+            v1.append('UU %s' % path)
+            v2.append('u UU N... 100644 100644 100644 100644 %s %s %s %s' % (OID, OID, OID, path))
+        else:
+            v1.append('?? %s' % path)
+            v2.append('? %s' % path)
+    return '\n'.join(v1) + '\n', '\0'.join(v2) + '\0'
+
+
+def old_status(result):
+    # GitStatusCommand.status_done and status_filter, before porcelain.py
+    def status_filter(item):
+        if not re.match(r'^[ MADRCU?!]{1,2}\s+.*', item):
+            return False
+        return len(item) > 0
+    return list(filter(status_filter, result.rstrip().split('\n')))
+
+
+def old_status_paths(result):
+    # ...and then taking each line apart, as the callers did one by one; a
+    # rename has to be split on ' -> ' to get at either path
+    entries = []
+    for item in old_status(result):
+        path = item[3:].strip('"')
+        orig_path = None
+        if item[0] in 'RC':
+            orig_path, _, path = path.partition(' -> ')
+        entries.append((item[:2], path, orig_path))
+    return entries
+
+
+def main(entries=100000):
+    v1, v2 = listings(entries)
+    timings = [
+        ('old v1, split and filtered', lambda: old_status(v1)),
+        ('old v1, taken apart', lambda: old_status_paths(v1)),
+        ('parse_status into a list', lambda: list(porcelain.parse_status(v2))),
+        ('parse_status, paths only', lambda: [entry.path for entry in porcelain.parse_status(v2)]),
+    ]
+    # interleaved, and the median taken, as one run can easily be off by a third
+    runs = dict((name, []) for name, run in timings)
+    for _ in range(15):
+        for name, run in timings:
+            runs[name].append(timeit.timeit(run, number=1))
+    for name, run in timings:
+        print('%-32s %6.1f ms' % (name, sorted(runs[name])[len(runs[name]) // 2] * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,196 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import io
+import os
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from util import GIT_DIR  # noqa
+import linediff
+
+
+def git_annotations(old, new, directory):
+    """The annotations GitAnnotateCommand.parse_diff made from `git diff -u`.
+
+    This is that method as it was, except that hunk headers leaving out a
+    count of one are read too; see classify().
+    """
+    paths = []
+    for name, text in (('old', old), ('new', new)):
+        path = os.path.join(directory, name)
+        with io.open(path, 'w', encoding='utf-8', newline='') as f:
+            f.write(text)
+        paths.append(path)
+    proc = subprocess.Popen(
+        ['git', '-c', 'diff.algorithm=myers', '-c', 'diff.indentHeuristic=true',
+         'diff', '--no-index', '--no-color', '--no-ext-diff', '-u', '--'] + paths,
+        stdout=subprocess.PIPE)
+    result = proc.communicate()[0].decode('utf-8')
+
+    lines = result.splitlines()
+    matcher = re.compile(r'^@@ -([0-9]*)(?:,([0-9]*))? \+([0-9]*)(?:,([0-9]*))? @@')
+    diff = []
+    for line_index in range(0, len(lines)):
+        line = lines[line_index]
+        if not line.startswith('@'):
+            continue
+        match = matcher.match(line)
+        if not match:
+            continue
+        line_after = int(match.group(3))
+        chunk_index = line_index + 1
+        tracked_line_index = line_after - 1
+        deletion = False
+        insertion = False
+        while True:
+            line = lines[chunk_index]
+            if line.startswith('@'):
+                break
+            elif line.startswith('-'):
+                if not line.strip() == '-':
+                    deletion = True
+                tracked_line_index -= 1
+            elif line.startswith('+'):
+                if deletion and not line.strip() == '+':
+                    diff.append(['x', tracked_line_index])
+                    insertion = True
+                elif not deletion:
+                    insertion = True
+                    diff.append(['+', tracked_line_index])
+            else:
+                if not insertion and deletion:
+                    diff.append(['-', tracked_line_index])
+                insertion = deletion = False
+            tracked_line_index += 1
+            chunk_index += 1
+            if chunk_index >= len(lines):
+                break
+    return diff
+
+
+WORDS = ['', '', 'x = 1', 'return x', 'if x:', 'else:', '}', '{', 'pass', 'def f():', '# note']
+
+
+def random_text(rng, lines):
+    text = ''.join(' ' * (4 * rng.randint(0, 2)) + rng.choice(WORDS) + '\n' for _ in range(lines))
+    if text and rng.random() < 0.2:
+        # no newline at the end
+        text = text[:-1]
+    return text
+
+
+def random_edit(rng, text):
+    lines = linediff.split_lines(text)
+    for _ in range(rng.randint(1, 4)):
+        i = rng.randint(0, len(lines))
+        action = rng.random()
+        if action < 0.4:
+            lines[i:i] = linediff.split_lines(random_text(rng, rng.randint(1, 4)))
+        elif action < 0.7:
+            del lines[i:i + rng.randint(1, 4)]
+        else:
+            lines[i:i + 1] = linediff.split_lines(random_text(rng, rng.randint(1, 3)))
+    text = ''.join(line if line.endswith('\n') else line + '\n' for line in lines)
+    if rng.random() < 0.2:
+        text = text[:-1]
+    return text
+
+
+def has_git():
+    try:
+        subprocess.Popen(['git', '--version'], stdout=subprocess.PIPE).communicate()
+    except OSError:
+        return False
+    return True
+
+
+@unittest.skipUnless(has_git(), "needs git")
+class ClassifyMatchesGitTest(unittest.TestCase):
+    # A seeded corpus of random texts and edits, annotated both ways
+    CASES = 300
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_corpus(self):
+        rng = random.Random(1234)
+        for case in range(self.CASES):
+            old = random_text(rng, rng.randint(0, 40))
+            new = random_edit(rng, old)
+            expected = git_annotations(old, new, self.directory)
+            actual = linediff.classify(linediff.split_lines(old), linediff.split_lines(new))
+            self.assertEqual(actual, expected, "case %d:\n%r\n%r" % (case, old, new))
+
+    def test_identical(self):
+        self.assertEqual(linediff.classify(['a\n'], ['a\n']), [])
+
+
+def edit_lines(rng, lines, edits):
+    lines = list(lines)
+    for _ in range(edits):
+        i = rng.randint(0, len(lines))
+        action = rng.random()
+        if action < 0.4:
+            lines[i:i] = linediff.split_lines(random_text(rng, rng.randint(1, 4)))
+        elif action < 0.7:
+            del lines[i:i + rng.randint(1, 4)]
+        else:
+            lines[i:i + 1] = linediff.split_lines(random_text(rng, rng.randint(1, 3)))
+    return [line if line.endswith('\n') else line + '\n' for line in lines]
+
+
+def cost(codes):
+    return sum(i2 - i1 + j2 - j1 for tag, i1, i2, j1, j2 in codes if tag != 'equal')
+
+
+class UpdateOpcodesTest(unittest.TestCase):
+    # Runs of small edits to a buffer already diffed against HEAD, updated
+    # the way live annotations are, compared with diffing from scratch
+    RUNS = 400
+    STEPS = 3
+
+    def assertValid(self, a, b, codes):
+        i = j = 0
+        for tag, i1, i2, j1, j2 in codes:
+            self.assertEqual((i1, j1), (i, j))
+            if tag == 'equal':
+                self.assertEqual(a[i1:i2], b[j1:j2])
+            i, j = i2, j2
+        self.assertEqual((i, j), (len(a), len(b)))
+
+    def check(self, size, seed):
+        rng = random.Random(seed)
+        differ = updates = 0
+        for run in range(self.RUNS):
+            head = linediff.split_lines(random_text(rng, rng.randint(0, size)))
+            head = [line if line.endswith('\n') else line + '\n' for line in head]
+            old = edit_lines(rng, head, rng.randint(1, max(6, size // 15)))
+            codes = linediff.opcodes(head, old)
+            for step in range(self.STEPS):
+                new = edit_lines(rng, old, rng.randint(1, 2))
+                codes = linediff.update_opcodes(head, old, new, codes)
+                full = linediff.opcodes(head, new)
+                self.assertValid(head, new, codes)
+                # a different alignment is fine, a longer one isn't
+                self.assertEqual(cost(codes), cost(full))
+                differ += codes != full
+                updates += 1
+                old = new
+        return differ / updates
+
+    def test_small_files(self):
+        self.assertLess(self.check(80, 1), 0.005)
+
+    def test_dense_changes(self):
+        self.assertLess(self.check(400, 2), 0.03)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import io
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from util import GIT_DIR  # noqa
+import patch
+from bench_patch import linear_select
+from test_linediff import has_git
+
+
+class HunkIndexTest(unittest.TestCase):
+    def test_overlap(self):
+        diff = patch.parse_diff(
+            'diff --git a/x b/x\n@@ -1,3 +1,3 @@\n a\n-b\n+c\n d\n@@ -2,2 +2,2 @@\n c\n-e\n+f\n')
+        self.assertRaises(ValueError, patch.HunkIndex, diff.hunks)
+        # by the lines of the diff they're apart
+        patch.HunkIndex(diff.hunks, direct=True)
+
+
+@unittest.skipUnless(has_git(), "needs git")
+class GitHunksTest(unittest.TestCase):
+    # Whatever git's hunks look like, they can be indexed, and the index
+    # finds what checking every hunk would
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def diff(self, old, new, context):
+        paths = []
+        for name, lines in (('a', old), ('b', new)):
+            path = os.path.join(self.directory, name)
+            with io.open(path, 'w', encoding='utf-8', newline='') as f:
+                f.write(''.join(lines))
+            paths.append(path)
+        proc = subprocess.Popen(
+            ['git', 'diff', '--no-index', '--no-color', '--no-ext-diff', '-U%d' % context, '--'] + paths,
+            stdout=subprocess.PIPE)
+        return proc.communicate()[0].decode('utf-8')
+
+    def test_random_edits(self):
+        rng = random.Random(21)
+        for case in range(150):
+            old = ['line %d\n' % rng.randint(0, 30) for _ in range(rng.randint(0, 60))]
+            new = list(old)
+            for _ in range(rng.randint(1, 8)):
+                i = rng.randint(0, len(new))
+                if rng.random() < 0.5:
+                    new[i:i] = ['new %d\n' % rng.randint(0, 5)]
+                else:
+                    del new[i:i + rng.randint(1, 3)]
+            context = rng.choice([0, 1, 3])
+            diff = patch.parse_diff(self.diff(old, new, context))
+            lines = max(len(old), len(new)) + 2
+            ranges = [tuple(sorted((rng.randint(0, lines), rng.randint(0, lines)))) for _ in range(3)]
+            for direct in (False, True):
+                self.assertEqual(diff.select(ranges, direct), linear_select(diff, ranges, direct))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,10 @@
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import os
+import sys
+
+# The modules under test that don't need Sublime Text are imported straight
+# out of git/, by name, so that git/__init__.py (which does) isn't run.
+GIT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'git')
+if GIT_DIR not in sys.path:
+    sys.path.insert(0, GIT_DIR)